@@ -0,0 +1,419 @@
+##Notes: Local stand-ins for the things not_tunein talks to, for benchmarks.
+##       Each fake runs in a daemon thread and logs what it was asked to do
+##       (with a perf_counter timestamp) to `events`, so a benchmark can time
+##       an action end to end.
+
+import json
+import re
+import select
+import socketserver
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class EventLog:
+    """(time, source, what) tuples from every fake; wait() blocks for a match."""
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.items = []
+
+    def add(self, source, what):
+        with self.cond:
+            self.items.append((time.perf_counter(), source, what))
+            self.cond.notify_all()
+
+    def wait(self, pattern, since, timeout=10):
+        """Time of the first event at or after `since` whose "source what" matches `pattern`."""
+        rx = re.compile(pattern)
+        deadline = time.perf_counter() + timeout
+        with self.cond:
+            while True:
+                for t, source, what in self.items:
+                    if t >= since and rx.search(f"{source} {what}"): return t
+                left = deadline - time.perf_counter()
+                if left <= 0: return None
+                self.cond.wait(left)
+
+events = EventLog()
+
+def serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class Threaded(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+# MPD: enough of the protocol for not_tunein's client (command lists, idle/noidle)
+class MPDState:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.volume = 50
+        self.state = "stop"
+        self.playlist = []
+        self.title = "Boards of Canada - Roygbiv"
+        self.serial = 0
+        self.changed = {}   # subsystem -> serial of last change
+
+    def touch(self, *subsystems):
+        with self.cond:
+            self.serial += 1
+            for s in subsystems: self.changed[s] = self.serial
+            self.cond.notify_all()
+
+class MPDHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        mpd = self.server.mpd
+        self.wfile.write(b"OK MPD 0.23.5\n")
+        batch = None
+        while True:
+            line = self.rfile.readline()
+            if not line: return
+            line = line.decode().strip()
+            cmd, _, arg = line.partition(" ")
+            arg = arg.strip('"')
+            if cmd == "idle":
+                self.idle(mpd, arg.split())
+                continue
+            if cmd in ("command_list_begin", "command_list_ok_begin"):
+                batch, list_ok = b"", cmd.endswith("ok_begin")
+                continue
+            if cmd == "command_list_end":
+                self.wfile.write(batch + b"OK\n")
+                batch = None
+                continue
+            reply = self.run(mpd, cmd, arg)
+            if batch is None: self.wfile.write(reply + b"OK\n")
+            else: batch += reply + (b"list_OK\n" if list_ok else b"")
+
+    def idle(self, mpd, subsystems):
+        with mpd.cond: seen = mpd.serial
+        while True:
+            with mpd.cond:
+                hit = [s for s, n in mpd.changed.items() if n > seen and (not subsystems or s in subsystems)]
+                if not hit: mpd.cond.wait(0.05)
+            if hit:
+                self.wfile.write("".join(f"changed: {s}\n" for s in hit).encode() + b"OK\n")
+                return
+            r, _, _ = select.select([self.connection], [], [], 0)
+            if r:
+                self.rfile.readline()   # noidle
+                self.wfile.write(b"OK\n")
+                return
+
+    def run(self, mpd, cmd, arg):
+        events.add("mpd", f"{cmd} {arg}".strip())
+        if cmd == "status":
+            return f"volume: {mpd.volume}\nstate: {mpd.state}\nplaylistlength: {len(mpd.playlist)}\n".encode()
+        if cmd == "currentsong":
+            if not mpd.playlist: return b""
+            return f"file: {mpd.playlist[0]}\nName: Bench Radio\nTitle: {mpd.title}\n".encode()
+        if cmd == "setvol":
+            mpd.volume = int(arg)
+            mpd.touch("mixer")
+        elif cmd == "clear":
+            mpd.playlist = []
+            mpd.touch("playlist")
+        elif cmd == "add":
+            mpd.playlist.append(arg)
+            mpd.touch("playlist")
+        elif cmd == "play":
+            mpd.state = "play"
+            mpd.touch("player")
+        elif cmd == "stop":
+            mpd.state = "stop"
+            mpd.touch("player")
+        return b""
+
+def fake_mpd(port=0, host="127.0.0.1"):
+    server = Threaded((host, port), MPDHandler)
+    server.mpd = MPDState()
+    return serve(server)
+
+# Station sheet and a KCRW-style now-playing API
+class SheetHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args): None
+
+    def do_GET(self):
+        events.add("http", self.path)
+        if self.path.startswith("/stations.tsv"):
+            body, kind = self.server.tsv.encode(), "text/tab-separated-values"
+        elif self.path.startswith("/kcrw"):
+            body, kind = json.dumps({'artist': 'Bench Artist', 'title': 'Bench Title', 'album': 'Bench'}).encode(), "application/json"
+        elif self.path.startswith("/stream/"):
+            return self.stream()
+        else:
+            self.send_error(404)
+            return
+        etag = '"%x"' % hash(body)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", kind)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream(self):
+        # Endless silence-ish MP3 frames, for anything that actually connects,
+        # with a new ICY StreamTitle every few seconds if the client asks
+        metaint = 8192 if self.headers.get("Icy-MetaData") == "1" else 0
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/mpeg")
+        self.send_header("icy-br", "128")
+        if metaint: self.send_header("icy-metaint", str(metaint))
+        self.end_headers()
+        audio = (b"\xff\xfb\x90\x64" + bytes(413)) * 20
+        sent, song = 0, 0
+        try:
+            while True:
+                for i in range(0, len(audio), 4096):
+                    chunk = audio[i:i + 4096]
+                    if metaint and sent + len(chunk) >= metaint:
+                        head, chunk = chunk[:metaint - sent], chunk[metaint - sent:]
+                        title = f"StreamTitle='Bench Artist - Song {song // 10}';".encode()
+                        title += bytes(-len(title) % 16)
+                        self.wfile.write(head + bytes([len(title) // 16]) + title)
+                        sent, song = 0, song + 1
+                    self.wfile.write(chunk)
+                    sent += len(chunk)
+                time.sleep(0.2)
+        except OSError: None
+
+def station_tsv(host, n):
+    rows = ["Name\tURL\tNotes"]
+    for i in range(n):
+        rows.append(f"Bench {i:05d}\thttp://{host}/stream/{i}\tbench station {i}")
+    rows.append(f"KCRW Eclectic 24\thttp://{host}/stream/kcrw\tEclectic")
+    return "\n".join(rows) + "\n"
+
+def fake_sheet(stations=20, port=0, host="127.0.0.1"):
+    server = ThreadingHTTPServer((host, port), SheetHandler)
+    server.daemon_threads = True
+    server.tsv = station_tsv(f"{host}:{server.server_port}", stations)
+    return serve(server)
+
+# Sonos: one HTTP server per speaker on 127.0.0.N:1400 (SoCo always uses
+# port 1400), answering the UPnP SOAP actions and event subscriptions we use
+SOAP = ('<?xml version="1.0"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+        's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>'
+        '<u:{action}Response xmlns:u="{service}">{args}</u:{action}Response></s:Body></s:Envelope>')
+
+# The in-arguments of each action, served as the services' SCPD documents
+# (SoCo reads these to build its requests)
+ACTIONS = {
+    'AVTransport': {'SetAVTransportURI': ['InstanceID', 'CurrentURI', 'CurrentURIMetaData'], 'Play': ['InstanceID', 'Speed'],
+                    'Stop': ['InstanceID'], 'GetPositionInfo': ['InstanceID'], 'GetMediaInfo': ['InstanceID'],
+                    'GetTransportInfo': ['InstanceID'], 'ConfigureSleepTimer': ['InstanceID', 'NewSleepTimerDuration'],
+                    'BecomeCoordinatorOfStandaloneGroup': ['InstanceID']},
+    'RenderingControl': {'GetVolume': ['InstanceID', 'Channel'], 'SetVolume': ['InstanceID', 'Channel', 'DesiredVolume']},
+    'DeviceProperties': {'GetHouseholdID': [], 'GetZoneAttributes': []},
+    'ZoneGroupTopology': {'GetZoneGroupState': []},
+}
+
+def scpd(service):
+    arg = lambda name: f"<argument><name>{name}</name><direction>in</direction><relatedStateVariable>A_ARG</relatedStateVariable></argument>"
+    actions = "".join(f"<action><name>{a}</name><argumentList>{''.join(arg(n) for n in args)}</argumentList></action>"
+                      for a, args in ACTIONS[service].items())
+    return ('<?xml version="1.0"?><scpd xmlns="urn:schemas-upnp-org:service-1-0">'
+            f'<actionList>{actions}</actionList><serviceStateTable>'
+            '<stateVariable sendEvents="no"><name>A_ARG</name><dataType>string</dataType></stateVariable>'
+            '</serviceStateTable></scpd>')
+
+def xml_escape(s): return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+
+class SonosHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args): None
+
+    def reply(self, body, kind="text/xml", status=200, headers=()):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", kind)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in headers: self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        speaker = self.server.speaker
+        if self.path == "/xml/device_description.xml":
+            self.reply('<?xml version="1.0"?><root xmlns="urn:schemas-upnp-org:device-1-0"><device>'
+                       f'<roomName>{speaker.name}</roomName><serialNum>00-00-00-00-00-{speaker.n:02X}:1</serialNum>'
+                       '<softwareVersion>1</softwareVersion><hardwareVersion>1</hardwareVersion>'
+                       '<modelNumber>S1</modelNumber><modelName>Bench</modelName><displayVersion>1</displayVersion>'
+                       f'<UDN>uuid:{speaker.uid}</UDN></device></root>')
+        elif self.path.startswith("/xml/") and self.path[5:-5] in ACTIONS: self.reply(scpd(self.path[5:-5]))
+        else: self.reply("", status=404)
+
+    def do_SUBSCRIBE(self):
+        if self.headers.get("Content-Length"): self.rfile.read(int(self.headers["Content-Length"]))
+        events.add(self.server.speaker.name, f"SUBSCRIBE {self.path}")
+        self.reply("", headers=[("SID", f"uuid:sub-{time.time_ns()}"), ("TIMEOUT", "Second-1800")])
+
+    def do_UNSUBSCRIBE(self): self.reply("")
+
+    def do_POST(self):
+        speaker = self.server.speaker
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        service, _, action = self.headers.get("SOAPACTION", "").strip('"').partition("#")
+        events.add(speaker.name, action)
+        out = speaker.action(action, body)
+        args = "".join(f"<{k}>{xml_escape(str(v))}</{k}>" for k, v in out.items())
+        self.reply(SOAP.format(action=action, service=service, args=args))
+
+class FakeSpeaker:
+    def __init__(self, n, group):
+        self.n = n
+        self.ip = f"127.0.0.{n + 1}"
+        self.name = f"Bench {n}"
+        self.uid = f"RINCON_BENCH{n:06d}1400"
+        self.group = group
+        self.volume = 20
+        self.uri = ""
+        self.state = "STOPPED"
+
+    def action(self, action, body):
+        arg = lambda name: (re.search(f"<{name}>(.*?)</{name}>", body, re.S) or [None, ""])[1]
+        if action == "GetZoneGroupState": return {'ZoneGroupState': self.group.state()}
+        if action == "GetHouseholdID": return {'CurrentHouseholdID': "Sonos_Bench"}
+        if action == "GetVolume": return {'CurrentVolume': self.volume}
+        if action == "SetVolume": self.volume = int(arg("DesiredVolume"))
+        if action == "SetAVTransportURI": self.uri = arg("CurrentURI")
+        if action == "Play": self.state = "PLAYING"
+        if action == "Stop": self.state = "STOPPED"
+        if action == "GetTransportInfo":
+            return {'CurrentTransportState': self.state, 'CurrentTransportStatus': 'OK', 'CurrentSpeed': '1'}
+        if action == "GetMediaInfo":
+            return {'NrTracks': 1, 'CurrentURI': self.uri, 'CurrentURIMetaData': '', 'PlayMedium': 'NETWORK'}
+        if action == "GetPositionInfo":
+            return {'Track': 1, 'TrackDuration': '0:00:00', 'TrackURI': self.uri, 'RelTime': '0:00:00',
+                    'TrackMetaData': 'NOT_IMPLEMENTED'}
+        return {}
+
+class FakeSonos:
+    """`n` speakers, each on its own loopback address, sharing one zone group state."""
+    def __init__(self, n):
+        self.speakers = [FakeSpeaker(i + 1, self) for i in range(n)]
+        self.servers = []
+        for speaker in self.speakers:
+            server = ThreadingHTTPServer((speaker.ip, 1400), SonosHandler)
+            server.daemon_threads = True
+            server.speaker = speaker
+            self.servers.append(serve(server))
+
+    def state(self):
+        members = "".join(f'<ZoneGroup Coordinator="{s.uid}" ID="{s.uid}:1"><ZoneGroupMember UUID="{s.uid}" '
+                          f'Location="http://{s.ip}:1400/xml/device_description.xml" ZoneName="{s.name}" '
+                          'Invisible="0" IsZoneBridge="0"/></ZoneGroup>' for s in self.speakers)
+        return f"<ZoneGroupState><ZoneGroups>{members}</ZoneGroups><VanishedDevices/></ZoneGroupState>"
+
+    def zones(self): return {s.name: s.ip for s in self.speakers}
+
+    def shutdown(self):
+        for server in self.servers: server.shutdown()
+
+# MQTT: a small in-process 3.1.1 broker (QoS 0/1, wildcards, retained messages)
+def topic_matches(pattern, topic):
+    p, t = pattern.split("/"), topic.split("/")
+    for i, part in enumerate(p):
+        if part == "#": return True
+        if i >= len(t) or (part != "+" and part != t[i]): return False
+    return len(p) == len(t)
+
+def mqtt_string(s):
+    s = s.encode()
+    return struct.pack("!H", len(s)) + s
+
+def mqtt_packet(kind, body):
+    n, length = len(body), b""
+    while True:
+        byte, n = n % 128, n // 128
+        length += bytes([byte | (0x80 if n else 0)])
+        if not n: break
+    return bytes([kind]) + length + body
+
+class MQTTHandler(socketserver.BaseRequestHandler):
+    def read(self, n):
+        data = b""
+        while len(data) < n:
+            chunk = self.request.recv(n - len(data))
+            if not chunk: raise ConnectionError
+            data += chunk
+        return data
+
+    def handle(self):
+        broker = self.server.broker
+        self.lock = threading.Lock()
+        self.subs = []
+        try:
+            while True:
+                head = self.read(1)[0]
+                length, shift = 0, 0
+                while True:
+                    byte = self.read(1)[0]
+                    length |= (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80: break
+                body = self.read(length)
+                kind = head >> 4
+                if kind == 1: self.send(mqtt_packet(0x20, b"\x00\x00"))
+                elif kind == 3: broker.incoming(self, head, body)
+                elif kind == 8:
+                    pid, i, granted = body[:2], 2, b""
+                    while i < len(body):
+                        size = struct.unpack("!H", body[i:i + 2])[0]
+                        self.subs.append(body[i + 2:i + 2 + size].decode())
+                        granted += bytes([min(body[i + 2 + size], 1)])
+                        i += 3 + size
+                    with broker.lock: broker.clients.add(self)
+                    self.send(mqtt_packet(0x90, pid + granted))
+                    for topic, payload in list(broker.retained.items()):
+                        if any(topic_matches(s, topic) for s in self.subs):
+                            self.send(mqtt_packet(0x31, mqtt_string(topic) + payload))
+                elif kind == 10: self.send(mqtt_packet(0xB0, body[:2]))
+                elif kind == 12: self.send(mqtt_packet(0xD0, b""))
+                elif kind == 14: return
+        except (ConnectionError, OSError): None
+        finally:
+            with broker.lock: broker.clients.discard(self)
+
+    def send(self, data):
+        with self.lock: self.request.sendall(data)
+
+class FakeBroker:
+    def __init__(self, port=0, host="127.0.0.1"):
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.retained = {}
+        self.server = Threaded((host, port), MQTTHandler)
+        self.server.broker = self
+        self.port = self.server.server_address[1]
+        serve(self.server)
+
+    def incoming(self, client, head, body):
+        qos, retain = (head >> 1) & 3, head & 1
+        size = struct.unpack("!H", body[:2])[0]
+        topic = body[2:2 + size].decode()
+        rest = body[2 + size:]
+        if qos:
+            client.send(mqtt_packet(0x40, rest[:2]))
+            rest = rest[2:]
+        self.publish(topic, rest, retain)
+
+    def publish(self, topic, payload, retain=False):
+        if isinstance(payload, str): payload = payload.encode()
+        events.add("mqtt", topic)
+        if retain: self.retained[topic] = payload
+        with self.lock: clients = list(self.clients)
+        for c in clients:
+            if any(topic_matches(s, topic) for s in c.subs):
+                try: c.send(mqtt_packet(0x30, mqtt_string(topic) + payload))
+                except OSError: None
+
+    def shutdown(self): self.server.shutdown()
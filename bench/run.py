@@ -0,0 +1,247 @@
+##Notes: Benchmark not_tunein against local fakes (bench/fakes.py): an MPD server
+##       or Sonos speakers, the station sheet, a KCRW-style API and an MQTT broker.
+##
+##       python3 bench/run.py --backend mpc --clients 20
+##       python3 bench/run.py --backend sonos --zones 8 --compare bench/results/<earlier>.json
+##
+##       Results go to bench/results/ as JSON.  Sonos speakers listen on
+##       127.0.0.2... port 1400, which needs a loopback that answers on all of
+##       127/8 (Linux does; on macOS add aliases with ifconfig lo0 alias).
+
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import socketio
+
+import fakes
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def summary(samples):
+    """p50/p99/mean in ms for a list of seconds."""
+    if not samples: return None
+    ms = sorted(s * 1000 for s in samples)
+    pick = lambda q: ms[min(len(ms) - 1, int(round(q * (len(ms) - 1))))]
+    return {'n': len(ms), 'p50': round(pick(.5), 3), 'p99': round(pick(.99), 3), 'mean': round(statistics.fmean(ms), 3)}
+
+def write_settings(path, args, port, sheet, mpd, broker, zones):
+    settings = {
+        'BACKEND': args.backend,
+        'PORT': port,
+        'STATIONSCSV': f"http://127.0.0.1:{sheet.server_port}/stations.tsv",
+        'KCRW_URL': f"http://127.0.0.1:{sheet.server_port}/kcrw",
+        'STATIC_DIR': os.path.join(ROOT, "static"),
+        'HISTORY_DB': os.path.join(path, "tracks.db"),
+        'STATIONS_CACHE': os.path.join(path, "stations_cache.json"),
+        'ZONES_CACHE': os.path.join(path, "zones_cache.json"),
+        'ZONE_NETWORK_SCAN': False,
+        'ZONE_DISCOVER_TIMEOUT': 1,
+        'ENABLE_MQTT': True,
+        'MQTT_BROKER': "127.0.0.1",
+        'MQTT_PORT': broker.port,
+        'MQTT_TOPIC': "bench/tracks/record",
+        'MQTT_CMD_TOPIC': "bench/tracks/cmd",
+    }
+    if mpd: settings.update(MPD_HOST="127.0.0.1", MPD_PORT=mpd.server_address[1])
+    with open(os.path.join(path, "settings.py"), "w") as f:
+        for k, v in settings.items(): f.write(f"{k} = {v!r}\n")
+    if zones:
+        with open(settings['ZONES_CACHE'], "w") as f: json.dump(zones, f)
+
+def start_app(path, port, log):
+    # Run from the scratch dir so `from settings import *` finds the bench settings
+    code = f"import runpy; runpy.run_path({os.path.join(ROOT, 'not_tunein.py')!r}, run_name='__main__')"
+    return subprocess.Popen([sys.executable, "-c", code, str(port)], cwd=path, stdout=log, stderr=subprocess.STDOUT)
+
+def wait_ready(base, proc, timeout=60):
+    """Seconds until the first request and until the station list is served."""
+    t0 = time.perf_counter()
+    first = stations = None
+    while time.perf_counter() - t0 < timeout:
+        if proc.poll() is not None: raise RuntimeError("not_tunein exited during startup")
+        try:
+            if first is None and requests.get(base + "/", timeout=1).ok: first = time.perf_counter() - t0
+            if first is not None and requests.get(base + "/get_station", timeout=1).json():
+                stations = time.perf_counter() - t0
+                return first, stations
+        except requests.RequestException: None
+        time.sleep(0.01)
+    raise RuntimeError("not_tunein didn't come up")
+
+class Listener:
+    """One Socket.IO client in a zone's room, keeping that zone's state from snapshot + deltas."""
+    def __init__(self, base, zone, changed):
+        self.zone = zone
+        self.state = {}
+        self.deltas = 0
+        self.changed = changed
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on('snapshot', self.snapshot)
+        self.sio.on('delta', self.delta)
+        self.sio.connect(base, wait_timeout=10)
+        self.sio.emit('join_zone', {'zone': zone})
+
+    def snapshot(self, msg):
+        with self.changed:
+            self.state = dict(msg['state'])
+            self.changed.notify_all()
+
+    def delta(self, msg):
+        with self.changed:
+            self.state.update(msg['changes'])
+            self.deltas += 1
+            self.changed.notify_all()
+
+    def close(self): self.sio.disconnect()
+
+def timed_requests(fn, n, concurrency):
+    samples = []
+    def one(i):
+        t = time.perf_counter()
+        r = fn(i)
+        r.raise_for_status()
+        samples.append(time.perf_counter() - t)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool: list(pool.map(one, range(n)))
+    return summary(samples)
+
+def bench_routes(base, args, zones, stations):
+    s = requests.Session()
+    zone = zones[0]
+    out = {}
+    out['/play_station'] = timed_requests(
+        lambda i: s.post(base + "/play_station", json={'station': stations[i % len(stations)], 'zone': zone}),
+        args.requests, args.concurrency)
+    out['/track_status'] = timed_requests(lambda i: s.get(base + "/track_status", params={'zone': zone}), args.requests, args.concurrency)
+    out['/volume_up'] = timed_requests(lambda i: s.get(base + "/volume_up", params={'zone': zone}), args.requests, args.concurrency)
+    return out
+
+def bench_fanout(base, args, zone, listeners, changed):
+    """Time from a volume change to every client in the room seeing it."""
+    room = [l for l in listeners if l.zone == zone]
+    s = requests.Session()
+    samples = []
+    t_start = time.perf_counter()
+    for i in range(args.rounds):
+        volume = 30 + i % 2
+        t = time.perf_counter()
+        s.post(base + "/set_volume", json={'zone': zone, 'volume': volume}).raise_for_status()
+        with changed:
+            ok = changed.wait_for(lambda: all(l.state.get('volume') == volume for l in room), timeout=10)
+        if not ok: raise RuntimeError("volume change never reached every client")
+        samples.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - t_start
+    return {'clients': len(room), 'rounds': args.rounds,
+            'updates_per_s': round(args.rounds * len(room) / elapsed, 1),
+            'latency_ms': summary(samples)}
+
+def bench_mqtt(args, broker, zone):
+    """Time from a remote's MQTT command to the backend being told to change volume."""
+    target = "mpd setvol" if args.backend == "mpc" else f"{zone} SetVolume"
+    samples = []
+    for i in range(args.rounds):
+        t = time.perf_counter()
+        broker.publish("bench/tracks/cmd", json.dumps({'cmd': "vup" if i % 2 else "vdown", 'room': zone}))
+        done = fakes.events.wait(target, t)
+        if done is None: raise RuntimeError("MQTT command never reached the backend")
+        samples.append(done - t)
+        time.sleep(0.02)
+    return summary(samples)
+
+def compare(old, new):
+    """Print old vs new for every numeric leaf the two runs share."""
+    def leaves(d, prefix=""):
+        for k, v in d.items():
+            if isinstance(v, dict): yield from leaves(v, f"{prefix}{k}.")
+            elif isinstance(v, (int, float)) and not isinstance(v, bool): yield f"{prefix}{k}", v
+    a = dict(leaves({k: v for k, v in old.items() if k != 'meta'}))
+    for key, v in leaves({k: v for k, v in new.items() if k != 'meta'}):
+        if key in a:
+            change = f"{(v - a[key]) / a[key] * 100:+.1f}%" if a[key] else ""
+            print(f"{key:55} {a[key]:>12} {v:>12} {change:>9}")
+
+def git_commit():
+    try: return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception: return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark not_tunein against local fakes")
+    parser.add_argument("--backend", choices=["mpc", "sonos"], default="mpc")
+    parser.add_argument("--zones", type=int, default=4, help="fake Sonos speakers (sonos backend)")
+    parser.add_argument("--clients", type=int, default=10, help="Socket.IO clients, spread over the zones")
+    parser.add_argument("--stations", type=int, default=50, help="rows in the fake station sheet")
+    parser.add_argument("--requests", type=int, default=200, help="requests per timed route")
+    parser.add_argument("--concurrency", type=int, default=1, help="parallel requests per timed route")
+    parser.add_argument("--rounds", type=int, default=50, help="fan-out and MQTT rounds")
+    parser.add_argument("--out", help="result file (default bench/results/<time>-<backend>.json)")
+    parser.add_argument("--compare", help="earlier result file to compare against")
+    parser.add_argument("--verbose", action="store_true", help="show not_tunein's output")
+    args = parser.parse_args()
+
+    sheet = fakes.fake_sheet(args.stations)
+    broker = fakes.FakeBroker()
+    mpd = sonos = None
+    if args.backend == "mpc":
+        mpd = fakes.fake_mpd()
+        zones = ["mpc"]
+    else:
+        sonos = fakes.FakeSonos(args.zones)
+        zones = list(sonos.zones())
+
+    results = {'meta': {'time': time.strftime("%Y-%m-%dT%H:%M:%S"), 'commit': git_commit(), 'python': platform.python_version(),
+                        'platform': platform.platform(), 'args': vars(args)}}
+    with tempfile.TemporaryDirectory(prefix="not_tunein_bench") as path:
+        port = free_port()
+        base = f"http://127.0.0.1:{port}"
+        write_settings(path, args, port, sheet, mpd, broker, sonos.zones() if sonos else None)
+        log = None if args.verbose else open(os.path.join(path, "not_tunein.log"), "w")
+        proc = start_app(path, port, log)
+        listeners = []
+        try:
+            first, ready = wait_ready(base, proc)
+            results['startup'] = {'first_request_s': round(first, 3), 'stations_ready_s': round(ready, 3)}
+            stations = list(requests.get(base + "/get_station").json())
+
+            changed = threading.Condition()
+            for i in range(args.clients): listeners.append(Listener(base, zones[i % len(zones)], changed))
+            with changed: changed.wait_for(lambda: all('volume' in l.state or l.deltas for l in listeners), timeout=2)
+
+            results['latency_ms'] = bench_routes(base, args, zones, stations)
+            results['fanout'] = bench_fanout(base, args, zones[0], listeners, changed)
+            results['mqtt'] = {'command_to_action_ms': bench_mqtt(args, broker, zones[0])}
+        finally:
+            for l in listeners:
+                try: l.close()
+                except Exception: None
+            proc.terminate()
+            try: proc.wait(5)
+            except subprocess.TimeoutExpired: proc.kill()
+            if log:
+                log.close()
+                if proc.returncode not in (0, -15, None): print(open(log.name).read()[-4000:])
+
+    out = args.out or os.path.join(ROOT, "bench", "results", f"{time.strftime('%Y%m%d-%H%M%S')}-{args.backend}.json")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w") as f: json.dump(results, f, indent=2)
+    print(json.dumps({k: v for k, v in results.items() if k != 'meta'}, indent=2))
+    print(f"Saved {out}")
+    if args.compare:
+        with open(args.compare) as f: compare(json.load(f), results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+##Notes: Startup benchmark: where `import not_tunein` spends its time
+##       (a python -X importtime breakdown of its direct imports) and how long
+##       a fresh process takes to answer its first request and serve stations.
+##
+##       python3 bench/startup.py --backend mpc
+##       python3 bench/startup.py --backend sonos --compare bench/results/<earlier>.json
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import fakes
+import run
+
+def import_breakdown(path):
+    """(total seconds, {module: cumulative seconds}) for not_tunein and its direct imports."""
+    code = "import not_tunein"
+    env = dict(os.environ, PYTHONPATH=run.ROOT)
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=path, env=env,
+                         stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True, timeout=120)
+    children, total = {}, None
+    pending = {}
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line: continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit(): continue
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1: pending[name.strip()] = int(cumulative) / 1e6
+        if depth == 0:
+            if name.strip() == "not_tunein":
+                total = int(cumulative) / 1e6
+                children = pending
+            pending = {}
+    if total is None: raise RuntimeError("not_tunein failed to import:\n" + out.stderr[-2000:])
+    return total, children
+
+def import_time(path):
+    """Seconds to import not_tunein in a fresh interpreter, without importtime's overhead."""
+    code = "import time; t = time.perf_counter(); import not_tunein; print('import_s', time.perf_counter() - t)"
+    env = dict(os.environ, PYTHONPATH=run.ROOT)
+    out = subprocess.check_output([sys.executable, "-c", code], cwd=path, env=env, text=True, timeout=120)
+    return float(next(l for l in out.splitlines() if l.startswith("import_s ")).split()[1])
+
+def first_request(path, log):
+    port = run.free_port()
+    proc = run.start_app(path, port, log)
+    try: return run.wait_ready(f"http://127.0.0.1:{port}", proc)
+    finally:
+        proc.terminate()
+        try: proc.wait(5)
+        except subprocess.TimeoutExpired: proc.kill()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark not_tunein's startup")
+    parser.add_argument("--backend", choices=["mpc", "sonos"], default="mpc")
+    parser.add_argument("--zones", type=int, default=4, help="fake Sonos speakers (sonos backend)")
+    parser.add_argument("--stations", type=int, default=50, help="rows in the fake station sheet")
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes per measurement")
+    parser.add_argument("--top", type=int, default=12, help="imports to list in the breakdown")
+    parser.add_argument("--out", help="result file (default bench/results/<time>-startup-<backend>.json)")
+    parser.add_argument("--compare", help="earlier result file to compare against")
+    args = parser.parse_args()
+
+    sheet = fakes.fake_sheet(args.stations)
+    broker = fakes.FakeBroker()
+    mpd = fakes.fake_mpd() if args.backend == "mpc" else None
+    sonos = fakes.FakeSonos(args.zones) if args.backend == "sonos" else None
+
+    results = {'meta': {'time': time.strftime("%Y-%m-%dT%H:%M:%S"), 'commit': run.git_commit(), 'python': platform.python_version(),
+                        'platform': platform.platform(), 'args': vars(args)}}
+    with tempfile.TemporaryDirectory(prefix="not_tunein_startup") as path:
+        run.write_settings(path, args, run.free_port(), sheet, mpd, broker, sonos.zones() if sonos else None)
+        total, children = import_breakdown(path)
+        top = sorted(children.items(), key=lambda kv: -kv[1])[:args.top]
+        imports = [import_time(path) for _ in range(args.runs)]
+        with open(os.path.join(path, "not_tunein.log"), "w") as log:
+            ready = [first_request(path, log) for _ in range(args.runs)]
+
+    ms = lambda s: round(s * 1000, 1)
+    results['import_ms'] = {'median': ms(statistics.median(imports)), 'min': ms(min(imports)), 'importtime_total': ms(total),
+                            'by_module': {name: ms(s) for name, s in top}}
+    results['startup'] = {'first_request_s': round(statistics.median(f for f, _ in ready), 3),
+                          'stations_ready_s': round(statistics.median(s for _, s in ready), 3)}
+
+    out = args.out or os.path.join(run.ROOT, "bench", "results", f"{time.strftime('%Y%m%d-%H%M%S')}-startup-{args.backend}.json")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w") as f: json.dump(results, f, indent=2)
+    print(json.dumps({k: v for k, v in results.items() if k != 'meta'}, indent=2))
+    print(f"Saved {out}")
+    if args.compare:
+        with open(args.compare) as f: run.compare(json.load(f), results)
+
+if __name__ == '__main__':
+    main()
@@ -4,41 +4,85 @@
 
 import os
 import shutil
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, g
 import json
 import requests
 import sys
 from subprocess import getoutput as go
 
-# Check if settings.py exists, if not copy from example
-if not os.path.exists('settings.py'):
-    if os.path.exists('settings.py.example'):
-        shutil.copy('settings.py.example', 'settings.py')
-        print("Created settings.py from settings.py.example")
-        print("Please edit settings.py to configure your setup")
-    else:
+# Settings come from settings.py; until there is one the example's values
+# are used, and create_app() copies it into place for editing
+try: from settings import *
+except ModuleNotFoundError as E:
+    if E.name != 'settings': raise
+    if not os.path.exists('settings.py.example'):
         print("ERROR: settings.py.example not found!")
         sys.exit(1)
-
-from settings import *
-from flask_socketio import SocketIO, emit, send
+    with open('settings.py.example') as f: exec(f.read())
+from flask_socketio import SocketIO, emit, send, join_room, leave_room, rooms
 import threading
 import time
-from sqlite_utils import Database
-import yt_dlp
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from contextlib import contextmanager
+import bisect
+import sqlite3
+import base64
+import csv
+import io
+import zlib
+from urllib.parse import quote
 
 # Set defaults for optional settings if not defined
 if 'ENABLE_OSA' not in dir(): ENABLE_OSA = False
 if 'ENABLE_PYNC' not in dir(): ENABLE_PYNC = False
 if 'ENABLE_MQTT' not in dir(): ENABLE_MQTT = False
 if 'PORT' not in dir(): PORT = 9000
-
-# Allow PORT override via command line for backwards compatibility
-if len(sys.argv) > 1:
-    try:
-        PORT = int(sys.argv[1])
-    except:
-        pass
+if 'MPD_HOST' not in dir(): MPD_HOST = os.environ.get('MPD_HOST', 'localhost')
+if 'MPD_PORT' not in dir(): MPD_PORT = int(os.environ.get('MPD_PORT', 6600))
+if 'MPD_PASSWORD' not in dir(): MPD_PASSWORD = None
+if 'STATUS_POLL_INTERVAL' not in dir(): STATUS_POLL_INTERVAL = 30
+if 'HISTORY_DB' not in dir(): HISTORY_DB = "tracks.db"
+if 'HISTORY_FLUSH_INTERVAL' not in dir(): HISTORY_FLUSH_INTERVAL = 1
+if 'METADATA_TIMEOUT' not in dir(): METADATA_TIMEOUT = (3.05, 5)
+if 'METADATA_IDLE' not in dir(): METADATA_IDLE = 120
+if 'KCRW_URL' not in dir(): KCRW_URL = "https://tracklist-api.kcrw.com/Music/"
+if 'KEXP_URL' not in dir(): KEXP_URL = "https://api.kexp.org/v2/plays/?format=json&limit=1"
+if 'ICY_METADATA' not in dir(): ICY_METADATA = True
+if 'ICY_TIMEOUT' not in dir(): ICY_TIMEOUT = 15
+if 'YT_REFRESH_MARGIN' not in dir(): YT_REFRESH_MARGIN = 30 * 60
+if 'YT_MIN_REMAINING' not in dir(): YT_MIN_REMAINING = 5 * 60
+if 'YT_DEFAULT_TTL' not in dir(): YT_DEFAULT_TTL = 60 * 60
+if 'STATIONS_CACHE' not in dir(): STATIONS_CACHE = "stations_cache.json"
+if 'STATIONS_REFRESH' not in dir(): STATIONS_REFRESH = 60 * 60
+if 'STATIONS_TIMEOUT' not in dir(): STATIONS_TIMEOUT = (3.05, 15)
+if 'ZONES_CACHE' not in dir(): ZONES_CACHE = "zones_cache.json"
+if 'ZONE_RESCAN' not in dir(): ZONE_RESCAN = 10 * 60
+if 'ZONE_SCAN_WORKERS' not in dir(): ZONE_SCAN_WORKERS = 32
+if 'ZONE_PROBE_TIMEOUT' not in dir(): ZONE_PROBE_TIMEOUT = 2
+if 'ZONE_DISCOVER_TIMEOUT' not in dir(): ZONE_DISCOVER_TIMEOUT = 3
+if 'ZONE_NETWORK_SCAN' not in dir(): ZONE_NETWORK_SCAN = True
+if 'FANOUT_WORKERS' not in dir(): FANOUT_WORKERS = 16
+if 'MQTT_QOS' not in dir(): MQTT_QOS = 1
+if 'MQTT_OFFLINE_QUEUE' not in dir(): MQTT_OFFLINE_QUEUE = 100
+if 'MQTT_RECONNECT_MAX' not in dir(): MQTT_RECONNECT_MAX = 60
+if 'BROADCAST_TICK' not in dir(): BROADCAST_TICK = 0.1
+if 'STATIC_DIR' not in dir(): STATIC_DIR = "static"
+if 'STATION_PROBE_INTERVAL' not in dir(): STATION_PROBE_INTERVAL = 10 * 60
+if 'STATION_PROBE_WORKERS' not in dir(): STATION_PROBE_WORKERS = 16
+if 'STATION_PROBE_TIMEOUT' not in dir(): STATION_PROBE_TIMEOUT = (3.05, 5)
+if 'STATION_DEAD_AFTER' not in dir(): STATION_DEAD_AFTER = 2
+if 'STATIC_MIN_COMPRESS' not in dir(): STATIC_MIN_COMPRESS = 512
+if 'RELAY' not in dir(): RELAY = False
+if 'RELAY_BUFFER' not in dir(): RELAY_BUFFER = 1024 * 1024
+if 'RELAY_PREROLL' not in dir(): RELAY_PREROLL = 64 * 1024
+if 'RELAY_IDLE' not in dir(): RELAY_IDLE = 30
+if 'RELAY_TIMEOUT' not in dir(): RELAY_TIMEOUT = 15
+if 'TIMESHIFT' not in dir(): TIMESHIFT = 0
+if 'TIMESHIFT_DIR' not in dir(): TIMESHIFT_DIR = "timeshift"
+if 'TIMESHIFT_KBPS' not in dir(): TIMESHIFT_KBPS = 320
+if 'PLAY_TIMEOUT' not in dir(): PLAY_TIMEOUT = 15
+if 'PLAY_JOBS_KEEP' not in dir(): PLAY_JOBS_KEEP = 10 * 60
 
 osa = ENABLE_OSA
 pync = ENABLE_PYNC
@@ -54,21 +98,126 @@ def setTimeout(delay):
     return timer
 
 
-if BACKEND == "sonos": from soco import SoCo, discover
-if BACKEND == "sonos": from soco import SoCo, discover
-
-KCRW_url = "https://tracklist-api.kcrw.com/Music/"
+if BACKEND == "sonos":
+    from soco import SoCo, discover
+    from soco.discovery import scan_network
 
 
 BURL = f"http://localhost:{PORT}"
 
 zs = {}
-stations = {}
 
-app = Flask(__name__)
+app = Flask(__name__, static_folder=None)
 socketio = SocketIO(app)
 
-if pync: print("will let you know stuff")
+class Metrics:
+    """Counters, gauges and latency histograms, rendered in Prometheus text format.
+
+    Series are keyed by name plus a sorted tuple of labels.  Recording is a
+    dict lookup and a bisect under one lock, so it is cheap enough for every
+    request and backend call.  A gauge may be a callable, read at scrape time.
+    """
+    buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = {}     # name -> (type, help)
+        self.series = {}    # name -> {labels: value or [bucket counts..., sum, count]}
+
+    def describe(self, name, kind, help):
+        self.kinds[name] = (kind, help)
+        self.series.setdefault(name, {})
+
+    def inc(self, name, n=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series[name]
+            series[key] = series.get(key, 0) + n
+
+    def set(self, name, value, **labels):
+        with self.lock: self.series[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, seconds, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            h = self.series[name].get(key)
+            if h is None: h = self.series[name][key] = [0] * (len(self.buckets) + 3)
+            h[bisect.bisect_left(self.buckets, seconds)] += 1
+            h[-2] += seconds
+            h[-1] += 1
+
+    @contextmanager
+    def timed(self, op):
+        """Time a backend operation (usable as a decorator too); exceptions count as errors."""
+        start = time.perf_counter()
+        try: yield
+        except Exception:
+            self.inc('not_tunein_backend_errors_total', op=op)
+            raise
+        finally: self.observe('not_tunein_backend_duration_seconds', time.perf_counter() - start, op=op)
+
+    @staticmethod
+    def _labels(key, extra=()):
+        pairs = list(key) + list(extra)
+        if not pairs: return ""
+        return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in pairs) + "}"
+
+    def render(self):
+        with self.lock: series = {name: dict(s) for name, s in self.series.items()}
+        out = []
+        for name, (kind, help) in self.kinds.items():
+            out.append(f"# HELP {name} {help}")
+            out.append(f"# TYPE {name} {kind}")
+            for key, value in series[name].items():
+                if kind == 'histogram':
+                    total = 0
+                    for bound, n in zip(self.buckets + ('+Inf',), value):
+                        total += n
+                        out.append(f"{name}_bucket{self._labels(key, [('le', bound)])} {total}")
+                    out.append(f"{name}_sum{self._labels(key)} {value[-2]}")
+                    out.append(f"{name}_count{self._labels(key)} {value[-1]}")
+                else:
+                    if callable(value):
+                        try: value = value()
+                        except Exception: continue
+                    out.append(f"{name}{self._labels(key)} {value}")
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+metrics.describe('not_tunein_http_request_duration_seconds', 'histogram', 'Time spent handling HTTP requests, by route')
+metrics.describe('not_tunein_http_requests_total', 'counter', 'HTTP requests, by route and status')
+metrics.describe('not_tunein_backend_duration_seconds', 'histogram', 'Time spent in backend operations (MPD, Sonos, YouTube, sheets, SQLite)')
+metrics.describe('not_tunein_backend_errors_total', 'counter', 'Backend operations that raised')
+metrics.describe('not_tunein_command_wait_seconds', 'histogram', 'Time zone commands waited in the queue before running')
+metrics.describe('not_tunein_broadcast_lag_seconds', 'histogram', 'Time from a zone state change to its delta being emitted')
+metrics.describe('not_tunein_socketio_clients', 'gauge', 'Connected Socket.IO clients')
+metrics.describe('not_tunein_socketio_emits_total', 'counter', 'Socket.IO messages sent, by event')
+metrics.describe('not_tunein_mqtt_messages_total', 'counter', 'MQTT messages, by direction')
+metrics.describe('not_tunein_mqtt_dropped_total', 'counter', 'MQTT publishes dropped because the offline buffer was full')
+metrics.describe('not_tunein_mqtt_outbox', 'gauge', 'MQTT publishes waiting for the broker')
+metrics.describe('not_tunein_history_queue', 'gauge', 'Plays waiting to be written to the history db')
+metrics.describe('not_tunein_icy_readers', 'gauge', 'Streams being read for ICY metadata')
+metrics.describe('not_tunein_relay_listeners', 'gauge', 'Speakers and browsers listening through the stream relay')
+metrics.describe('not_tunein_relay_bytes_total', 'counter', 'Bytes through the stream relay, by direction')
+metrics.describe('not_tunein_relay_skips_total', 'counter', 'Times a relay listener fell a buffer behind and skipped to the live edge')
+metrics.set('not_tunein_socketio_clients', 0)
+
+@app.before_request
+def metrics_start(): g.metrics_start = time.perf_counter()
+
+@app.after_request
+def metrics_record(response):
+    if 'metrics_start' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('not_tunein_http_request_duration_seconds', time.perf_counter() - g.metrics_start, route=route, method=request.method)
+        metrics.inc('not_tunein_http_requests_total', route=route, method=request.method, status=response.status_code)
+    return response
+
+@socketio.on("connect")
+def metrics_connect(auth=None): metrics.inc('not_tunein_socketio_clients')
+
+@socketio.on("disconnect")
+def metrics_disconnect(*args): metrics.inc('not_tunein_socketio_clients', -1)
 
 if ENABLE_MQTT:
     import paho.mqtt.client as mqtt
@@ -78,17 +227,31 @@ if ENABLE_MQTT:
     if 'MQTT_CMD_TOPIC' not in dir():
         MQTT_CMD_TOPIC = MQTT_TOPIC.replace("/record", "/cmd")
 
+    if 'MQTT_NOW_PLAYING_TOPIC' not in dir():
+        MQTT_NOW_PLAYING_TOPIC = MQTT_TOPIC.replace("/record", "/now_playing")
+
     def on_connect(client, userdata, flags, reason_code, properties):
+        global mqtt_connected
         print("Connected with result code "+str(reason_code))
-        client.subscribe(MQTT_CMD_TOPIC)
+        if reason_code.is_failure: return
+        client.subscribe(MQTT_CMD_TOPIC, qos=MQTT_QOS)
         print(f"Subscribed to {MQTT_CMD_TOPIC}")
+        with mqtt_lock:
+            mqtt_connected = True
+            pending = list(mqtt_outbox)
+            mqtt_outbox.clear()
+        if pending: print(f"Sending {len(pending)} queued MQTT messages")
+        for topic, payload, retain in pending: mqtt_publish(topic, payload, retain)
 
     def on_disconnect(client, userdata, disconnect_flags, reason_code, properties):
+        global mqtt_connected
+        with mqtt_lock: mqtt_connected = False
         print("Disconnected with result code "+str(reason_code))
 
     def on_message(client, userdata, msg):
         """Handle incoming MQTT commands from IR remote"""
-        global current_station, state, tt, current_station_idx, current_mqtt_node
+        global current_station, state, current_station_idx, current_mqtt_node
+        metrics.inc('not_tunein_mqtt_messages_total', direction='in')
         try:
             pl = json.loads(msg.payload)
             print(f"MQTT command received: {pl}")
@@ -97,46 +260,22 @@ if ENABLE_MQTT:
             if "room" in pl:
                 current_mqtt_node = pl['room']
 
+            # Commands are queued on the zone's worker so the MQTT network
+            # thread never waits on a speaker
+            zone = "mpc" if BACKEND == "mpc" else pl.get('room')
+            if zone not in zs:
+                print(f"MQTT: unknown zone {zone}")
+                return
+
             # Handle station selection
             if "station" in pl:
                 station_idx = pl['station']
-                if station_idx < len(skeys):
-                    station = skeys[station_idx]
+                if station_idx < len(catalog):
+                    station, station_url = catalog.at(station_idx)
                     current_station = station
                     current_station_idx = station_idx  # Track for button blinking
                     state = current_station
-
-                    # Get station URL
-                    station_url = stations[station]
-
-                    if BACKEND == "sonos":
-                        # YouTube URLs not supported on Sonos
-                        if is_youtube_url(station_url):
-                            print(f"MQTT: YouTube URLs not supported on Sonos")
-                            return
-                        zone = pl.get('room')
-                        if zone and zone in zs:
-                            SoCo(zs[zone]).play_uri("x-rincon-mp3radio://"+station_url, title=station)
-                            socketio.emit("play", {'result':'success','station':station,'zone':zone})
-                    elif BACKEND == "mpc":
-                        clear_mpc()
-                        # Extract stream URL for YouTube URLs
-                        if is_youtube_url(station_url):
-                            print(f"MQTT: extracting stream URL for {station}...")
-                            stream_url = get_youtube_stream_url(station_url)
-                            if stream_url:
-                                station_url = stream_url
-                            else:
-                                print(f"MQTT: Could not extract YouTube stream URL")
-                                return
-                        add_mpc(station_url)
-                        if osa and current_station.find("Apple Music") == 0:
-                            play_osa()
-                        else:
-                            play_mpc()
-                        socketio.emit("play", {'result':'success','station':station})
-                    print(f"Playing station: {station}")
-                    if pync: notify(f"Playing {station}",title='NT')
+                    commands(zone).start(station, station_url)
 
             # Handle commands
             if "cmd" in pl:
@@ -144,62 +283,31 @@ if ENABLE_MQTT:
 
                 if cmd == "stop":
                     state = "stopped"
-                    if BACKEND == "sonos":
-                        zone = pl.get('room')
-                        if zone and zone in zs:
-                            SoCo(zs[zone]).stop()
-                    elif BACKEND == "mpc":
-                        clear_mpc()
-                        stop_mpc()
-                        # Cancel sleep timer if exists
-                        try:
-                            if 'tt' in globals():
-                                tt.cancel()
-                                print("Sleep timer cancelled")
-                        except: pass
-                    print("Stopped playback")
-                    if pync: notify("Stopped",title='NT')
+                    commands(zone).queue(backend_stop)
 
                 elif cmd == "vup":
-                    if BACKEND == "sonos":
-                        zone = pl.get('room')
-                        if zone and zone in zs:
-                            current_vol = SoCo(zs[zone]).volume
-                            new_vol = current_vol + 5
-                            SoCo(zs[zone]).volume = new_vol
-                            socketio.emit("volume", {'volume': new_vol})
-                    elif BACKEND == "mpc":
-                        current_vol = int(get_vol_mpc())
-                        new_vol = current_vol + 5
-                        vol_mpc(new_vol)
-                        socketio.emit("volume", {'volume': new_vol})
+                    commands(zone).submit(delta=5)
                     print("Volume up")
 
                 elif cmd == "vdown":
-                    if BACKEND == "sonos":
-                        zone = pl.get('room')
-                        if zone and zone in zs:
-                            current_vol = SoCo(zs[zone]).volume
-                            new_vol = current_vol - 5
-                            SoCo(zs[zone]).volume = new_vol
-                            socketio.emit("volume", {'volume': new_vol})
-                    elif BACKEND == "mpc":
-                        current_vol = int(get_vol_mpc())
-                        new_vol = current_vol - 5
-                        vol_mpc(new_vol)
-                        socketio.emit("volume", {'volume': new_vol})
+                    commands(zone).submit(delta=-5)
                     print("Volume down")
 
                 elif cmd == "sleep":
-                    sleep_seconds = 60 * 60  # 1 hour
-                    if BACKEND == "sonos":
-                        zone = pl.get('room')
-                        if zone and zone in zs:
-                            SoCo(zs[zone]).set_sleep_timer(sleep_seconds)
-                            print(f"Sleep timer set for 1 hour on {zone}")
-                    elif BACKEND == "mpc":
-                        tt = setTimeout(sleep_seconds)
-                        print("Sleep timer set for 1 hour")
+                    commands(zone).submit(sleep=60 * 60)  # 1 hour
+
+                # Time shift, in order with the zone's other commands
+                elif cmd == "pause":
+                    commands(zone).queue(backend_pause)
+
+                elif cmd == "resume":
+                    commands(zone).queue(backend_seek)
+
+                elif cmd == "rewind":
+                    commands(zone).queue(backend_seek, pl.get('seconds', 300))
+
+                elif cmd == "live":
+                    commands(zone).queue(backend_seek, 0)
 
         except Exception as E:
             print(f"Error processing MQTT message: {E}")
@@ -222,104 +330,658 @@ if ENABLE_MQTT:
             return
         topic = f"{node}/lights"
         payload = json.dumps({"button": button, "color": color, "duration_ms": duration_ms})
-        try:
-            client.publish(topic, payload)
-        except Exception as e:
-            print(f"Error sending trellis light: {e}")
+        # A light that comes on after a reconnect would be stale, so don't queue it
+        mqtt_publish(topic, payload, offline=False)
+
+# One long-lived MQTT session carries both the IR commands and our publishes;
+# while it's down, publishes wait in a bounded buffer and go out on reconnect
+mqtt_outbox = deque(maxlen=MQTT_OFFLINE_QUEUE)
+mqtt_lock = threading.Lock()
+mqtt_connected = False
+metrics.set('not_tunein_mqtt_outbox', lambda: len(mqtt_outbox))
+
+def mqtt_queue(topic, payload, retain):
+    # Called with mqtt_lock held; a full deque silently drops its oldest entry
+    if len(mqtt_outbox) == mqtt_outbox.maxlen: metrics.inc('not_tunein_mqtt_dropped_total')
+    mqtt_outbox.append((topic, payload, retain))
+
+def mqtt_publish(topic, payload, retain=False, offline=True):
+    """Publish without blocking the caller; never touches the connection itself."""
+    if not ENABLE_MQTT: return
+    with mqtt_lock:
+        if not mqtt_connected:
+            if offline: mqtt_queue(topic, payload, retain)
+            return
+    try:
+        info = client.publish(topic, payload, qos=MQTT_QOS, retain=retain)
+        if info.rc == mqtt.MQTT_ERR_NO_CONN and offline:
+            with mqtt_lock: mqtt_queue(topic, payload, retain)
+        else: metrics.inc('not_tunein_mqtt_messages_total', direction='out')
+    except Exception as e:
+        print(f"MQTT publish error on {topic}: {e}")
 
 # YouTube Music support functions
-import subprocess
+import re
+from urllib.parse import urlparse, parse_qs, urljoin
 
 def is_youtube_url(url):
     """Check if URL is a YouTube or YouTube Music URL"""
     youtube_domains = ['youtube.com', 'youtu.be', 'music.youtube.com']
     return any(domain in url for domain in youtube_domains)
 
+# Resolved stream URLs, keyed by station URL: url -> (stream_url, expires_at)
+youtube_cache = {}
+_youtube_locks = {}
+youtube_wake = threading.Event()
+
+def youtube_expiry(stream_url):
+    """When a googlevideo URL stops working, from its expire= parameter (or /expire/N/ path)."""
+    try:
+        expire = parse_qs(urlparse(stream_url).query).get('expire')
+        if expire: return float(expire[0])
+        m = re.search(r"/expire/(\d+)", stream_url)
+        if m: return float(m.group(1))
+    except Exception: None
+    return time.time() + YT_DEFAULT_TTL
+
+@metrics.timed("youtube.resolve")
+def resolve_youtube(url):
+    """Resolve a YouTube URL to a direct audio URL with the yt_dlp library and cache it."""
+    import yt_dlp   # only loaded once a YouTube station is played: it's our slowest import
+    opts = {'format': 'bestaudio', 'playlist_items': '1', 'quiet': True, 'no_warnings': True, 'socket_timeout': 15}
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+    if info.get('entries'): info = next(iter(info['entries']))
+    stream_url = info.get('url') or info.get('manifest_url')
+    if not stream_url: raise ValueError("no playable format")
+    youtube_cache[url] = (stream_url, youtube_expiry(stream_url))
+    youtube_wake.set()
+    return stream_url
+
 def get_youtube_stream_url(url):
     """Get direct stream URL from YouTube using yt-dlp.
 
-    Returns a playable stream URL that MPD/Sonos can use.
-    Note: YouTube URLs expire after some time (typically 6 hours).
+    Returns a playable stream URL that MPD/Sonos can use.  Served from the
+    cache while it is good for at least YT_MIN_REMAINING seconds; the
+    refresher renews entries well before they expire.
     """
-    try:
-        # Use yt-dlp to get the direct stream URL
-        # --get-url extracts the actual media URL without downloading
-        # --playlist-items 1 gets only the first track from playlists
-        cmd = ['yt-dlp', '-f', 'bestaudio', '--get-url', '--playlist-items', '1', url]
-
-        print(f"  Extracting stream URL from YouTube...")
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=15)
-
-        if result.returncode == 0:
-            # Get the first line that looks like a URL (ignoring warnings)
-            for line in result.stdout.split('\n'):
-                line = line.strip()
-                if line.startswith('http'):
-                    print(f"  ✓ Got stream URL (length: {len(line)} chars)")
-                    return line
-
-        print(f"  Error: yt-dlp failed with return code {result.returncode}")
-        if result.stderr:
-            print(f"  Error output: {result.stderr[:200]}")
-        return None
-
-    except subprocess.TimeoutExpired:
-        print(f"  Error: yt-dlp timed out after 15 seconds")
-        return None
-    except Exception as e:
-        print(f"  Error extracting YouTube URL: {e}")
-        return None
+    cached = youtube_cache.get(url)
+    if cached and cached[1] - time.time() > YT_MIN_REMAINING: return cached[0]
+    lock = _youtube_locks.setdefault(url, threading.Lock())
+    with lock:
+        # Another thread may have resolved it while we waited
+        cached = youtube_cache.get(url)
+        if cached and cached[1] - time.time() > YT_MIN_REMAINING: return cached[0]
+        try:
+            print(f"  Extracting stream URL from YouTube...")
+            stream_url = resolve_youtube(url)
+            print(f"  ✓ Got stream URL (length: {len(stream_url)} chars)")
+            return stream_url
+        except Exception as e:
+            print(f"  Error extracting YouTube URL: {e}")
+            return None
+
+def youtube_refresher():
+    """Renew each resolved YouTube station YT_REFRESH_MARGIN before it expires.
+
+    Stations are first resolved when they're played, so yt_dlp isn't
+    loaded at all until someone plays one.
+    """
+    while True:
+        failed = False
+        for url in [u for u in catalog.stations.values() if u in youtube_cache]:
+            cached = youtube_cache.get(url)
+            if cached and cached[1] - time.time() > YT_REFRESH_MARGIN: continue
+            with _youtube_locks.setdefault(url, threading.Lock()):
+                try: resolve_youtube(url)
+                except Exception as e:
+                    print(f"  Error pre-resolving {url}: {e}")
+                    failed = True
+        due = [exp - YT_REFRESH_MARGIN for _, exp in youtube_cache.values()]
+        if failed: due.append(time.time() + 300)
+        youtube_wake.clear()
+        youtube_wake.wait(max(60, min(due) - time.time()) if due else None)
+
+# MPD protocol client (replaces shelling out to `mpc` for every command)
+import socket
+import queue
+import select
+
+class MPDError(Exception): pass
+
+class MPDClient:
+    """Minimal MPD protocol client with a small pool of persistent connections.
+
+    Connections are opened lazily, reused across threads and reopened if MPD
+    drops them (restart, connection_timeout).  A host starting with "/" is
+    treated as a unix socket path.  Replies are parsed into dicts.
+    """
+    def __init__(self, host="localhost", port=6600, password=None, timeout=10, pool_size=4):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._idle_conn = None
+
+    def _open(self):
+        if self.host.startswith("/"):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.host)
+        else:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        conn = (sock, sock.makefile("rb"))
+        hello = conn[1].readline()
+        if not hello.startswith(b"OK MPD "):
+            self._close(conn)
+            raise MPDError(f"unexpected MPD greeting: {hello!r}")
+        if self.password:
+            self._send(conn, [("password", self.password)])
+            self._read(conn)
+        return conn
+
+    def _close(self, conn):
+        for part in reversed(conn):
+            try: part.close()
+            except Exception: pass
+
+    def _acquire(self):
+        try: return self._pool.get_nowait()
+        except queue.Empty: return self._open()
+
+    def _release(self, conn):
+        try: self._pool.put_nowait(conn)
+        except queue.Full: self._close(conn)
+
+    @staticmethod
+    def _quote(arg):
+        arg = str(arg).replace("\\", "\\\\").replace('"', '\\"')
+        return f'"{arg}"'
+
+    def _send(self, conn, lines):
+        data = "".join(" ".join([cmd] + [self._quote(a) for a in args]) + "\n" for cmd, *args in lines)
+        conn[0].sendall(data.encode("utf-8"))
+
+    def _read(self, conn, list_ok=False):
+        """Read one reply; with list_ok, returns one list of pairs per command."""
+        replies, pairs = [], []
+        while True:
+            line = conn[1].readline()
+            if not line: raise ConnectionError("MPD closed the connection")
+            line = line.decode("utf-8", "replace").rstrip("\n")
+            if line == "OK":
+                if not list_ok: return pairs
+                return replies
+            if line == "list_OK":
+                replies.append(pairs)
+                pairs = []
+            elif line.startswith("ACK "):
+                raise MPDError(line)
+            else:
+                key, _, value = line.partition(": ")
+                pairs.append((key, value))
+
+    def _run(self, lines, list_ok=False):
+        with metrics.timed("mpd." + ("command_list" if list_ok else lines[0][0])):
+            return self._run_once(lines, list_ok)
+
+    def _run_once(self, lines, list_ok):
+        # One retry on a fresh connection covers pooled sockets that MPD has
+        # timed out or that died with a restart; protocol errors (ACK) aren't retried
+        for attempt in (0, 1):
+            conn = self._acquire()
+            try:
+                self._send(conn, lines)
+                reply = self._read(conn, list_ok)
+            except MPDError:
+                self._release(conn)
+                raise
+            except (OSError, ConnectionError):
+                self._close(conn)
+                if attempt: raise
+                continue
+            self._release(conn)
+            return reply
+
+    def command(self, cmd, *args):
+        """Run a single command and return its reply as a list of (key, value) pairs."""
+        return self._run([(cmd,) + args])
+
+    def command_list(self, cmds):
+        """Run several commands in one round trip; returns one reply per command."""
+        lines = [("command_list_ok_begin",)] + [tuple(c) for c in cmds] + [("command_list_end",)]
+        return self._run(lines, list_ok=True)
+
+    def idle(self, *subsystems, timeout=None):
+        """Block until MPD reports a change in one of `subsystems`.
+
+        Runs on its own connection so pooled commands are never held up behind
+        it.  Returns the changed subsystems, or [] if `timeout` seconds pass
+        first (the idle is then cancelled with noidle).
+        """
+        if self._idle_conn is None: self._idle_conn = self._open()
+        conn = self._idle_conn
+        try:
+            self._send(conn, [("idle",) + subsystems])
+            # select() on the raw socket instead of a socket timeout, which
+            # would leave the buffered reader unusable
+            ready, _, _ = select.select([conn[0]], [], [], timeout)
+            if not ready: self._send(conn, [("noidle",)])
+            pairs = self._read(conn)
+        except (OSError, ConnectionError):
+            self._close(conn)
+            self._idle_conn = None
+            raise
+        return [v for k, v in pairs if k == "changed"]
+
+    def status(self): return dict(self.command("status"))
+
+    def currentsong(self): return dict(self.command("currentsong"))
+
+mpd = MPDClient(MPD_HOST, MPD_PORT, MPD_PASSWORD)
 
 def clear_mpc():
-    go("mpc clear")
+    mpd.command("clear")
     if osa: go("osascript -e 'tell application \"Music\" to stop'")
 
-def add_mpc(s): go(f"mpc add {s}")
+def add_mpc(s): mpd.command("add", s)
 
-def play_mpc(): go(f"mpc play")
+def play_mpc(): mpd.command("play")
+
+def start_mpc(s):
+    """Replace the queue with a single URL and start it in one round trip."""
+    cmds = [("clear",), ("add", s)]
+    if osa: go("osascript -e 'tell application \"Music\" to stop'")
+    if osa and current_station.find("Apple Music") == 0:
+        mpd.command_list(cmds)
+        play_osa()
+    else:
+        mpd.command_list(cmds + [("play",)])
 
 def play_osa():
     go("osascript -e 'tell application \"Music\" to play (some track of library playlist 1)'")
 
-def stop_mpc(): go(f"mpc stop")
+def stop_mpc(): mpd.command("stop")
 
 def vol_mpc(i): 
-    go(f"mpc volume {i}")
+    mpd.command("setvol", max(0, min(100, int(i))))
     if osa: 
         vv = get_vol_mpc()
         go(f"osascript -e 'tell application \"Music\" to set sound volume to {vv}'")
 
 def get_vol_mpc():
-    vv = go("mpc volume").split(":")[1].strip().replace("%","")
+    vv = mpd.status().get("volume", "0")
     return vv
 
-last_track = {}
+def current_mpc(song):
+    """Format currentsong the way `mpc current` does, for the station heuristics."""
+    name = song.get('Name', '')
+    title = song.get('Title', '')
+    if song.get('Artist') and title: title = f"{song['Artist']} - {title}"
+    if name and title: return f"{name}: {title}"
+    return name or title or song.get('file', '')
+
+# Now-playing metadata providers: station APIs fetched on the server through
+# one shared session, cached per provider and refreshed in the background,
+# so status pushes and every client share a single upstream request
+http = requests.Session()
+http.headers['User-Agent'] = 'not_tunein'
+
+class MetadataProvider:
+    """Now-playing info for one station from a JSON API.
+
+    `parse` turns the JSON into a track dict (or None).  Responses are kept
+    for `ttl` seconds and revalidated with ETag/Last-Modified.  `get()` only
+    ever returns the cached value; fetching happens on the refresher thread.
+    """
+    def __init__(self, name, url, parse, ttl=15):
+        self.name = name
+        self.url = url
+        self.parse = parse
+        self.ttl = ttl
+        self.etag = None
+        self.modified = None
+        self.data = None
+        self.fetched = 0
+        self.last_used = 0
+
+    def refresh(self):
+        headers = {}
+        if self.etag: headers['If-None-Match'] = self.etag
+        if self.modified: headers['If-Modified-Since'] = self.modified
+        try:
+            with metrics.timed(f"metadata.{self.name}"):
+                r = http.get(self.url, headers=headers, timeout=METADATA_TIMEOUT)
+            if r.status_code != 304:
+                r.raise_for_status()
+                self.etag = r.headers.get('ETag')
+                self.modified = r.headers.get('Last-Modified')
+                data = self.parse(r.json())
+                if data != self.data:
+                    self.data = data
+                    metadata_changed(self)
+        except Exception as E:
+            print(f"{self.name} metadata error: {E}")
+        self.fetched = time.time()
+
+    def get(self):
+        self.last_used = time.time()
+        if self.last_used - self.fetched >= self.ttl: metadata_wake.set()
+        return self.data
+
+# Everything else gets its now-playing from the stream: one reader per
+# station asks for ICY metadata and skips the audio between metadata blocks
+# by reading it into one reusable buffer, so it's never copied or kept
+from http.client import HTTPConnection, HTTPSConnection, HTTPResponse
+
+tuned = {}   # zone -> stream url it's playing
+
+class IcyResponse(HTTPResponse):
+    """An HTTP response that also takes SHOUTcast v1's "ICY 200 OK" status line."""
+    def _read_status(self):
+        if self.fp.peek(4)[:4] != b"ICY ": return super()._read_status()
+        line = str(self.fp.readline(65537), "iso-8859-1").split(None, 2)
+        # Headers follow as in HTTP/1.0, and the body runs until the server closes
+        return "HTTP/1.0", int(line[1]), line[2].strip() if len(line) > 2 else ""
+
+def icy_open(url, redirects=5, metadata=True, offset=0, timeout=None):
+    """(connection, response) for a stream, following redirects.
+
+    Asks for ICY metadata unless metadata=False; offset asks for a byte
+    range, which servers are free to ignore (check for status 206).
+    timeout is seconds or (connect, read), defaulting to ICY_TIMEOUT; the
+    connection's connect_s is how long the last hop took to connect.
+    """
+    connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout or ICY_TIMEOUT,) * 2
+    headers = {'User-Agent': 'not_tunein'}
+    if metadata: headers['Icy-MetaData'] = '1'
+    if offset: headers['Range'] = f"bytes={offset}-"
+    for _ in range(redirects):
+        u = urlparse(url)
+        conn = (HTTPSConnection if u.scheme == "https" else HTTPConnection)(u.hostname, u.port, timeout=connect_timeout)
+        conn.response_class = IcyResponse
+        t = time.perf_counter()
+        conn.connect()
+        conn.connect_s = time.perf_counter() - t
+        conn.sock.settimeout(read_timeout)
+        conn.request("GET", (u.path or "/") + ("?" + u.query if u.query else ""), headers=headers)
+        r = conn.getresponse()
+        if r.status in (301, 302, 303, 307, 308) and r.getheader('Location'):
+            url = urljoin(url, r.getheader('Location'))
+            conn.close()
+            continue
+        if r.status not in (200, 206):
+            conn.close()
+            raise ValueError(f"HTTP {r.status}")
+        return conn, r
+    raise ValueError("too many redirects")
+
+def parse_icy(block):
+    """Track dict from an ICY metadata block (StreamTitle='Artist - Title';...)."""
+    text = block.rstrip(b"\0")
+    try: text = text.decode("utf-8")
+    except UnicodeDecodeError: text = text.decode("latin-1")
+    m = re.search(r"StreamTitle='(.*?)';", text, re.S)
+    title = m.group(1).strip() if m else ""
+    if not title: return None
+    artist, sep, song = title.partition(" - ")
+    return {'artist': artist.strip(), 'title': song.strip()} if sep else {'artist': '', 'title': title}
+
+class IcyProvider(MetadataProvider):
+    """Now-playing info read from the stream's own ICY metadata.
+
+    The reader thread starts on the first get() and runs while a zone is
+    tuned to the stream or someone asked within METADATA_IDLE; streams
+    without icy-metaint are given up on.
+    """
+    def __init__(self, name, url):
+        super().__init__(name, url, None, ttl=None)
+        self.lock = threading.Lock()
+        self.running = False
+        self.unsupported = False
+
+    def get(self):
+        self.last_used = time.time()
+        with self.lock:
+            if not self.running and not self.unsupported and not relayed(self.url):
+                self.running = True
+                threading.Thread(target=self.reader, daemon=True).start()
+        return self.data
+
+    def wanted(self):
+        # While the relay pulls this stream it hands us the metadata itself
+        if relayed(self.url): return False
+        return self.url in tuned.values() or time.time() - self.last_used < METADATA_IDLE
+
+    def reader(self):
+        view = memoryview(bytearray(16384))
+        while self.wanted() and not self.unsupported:
+            conn = None
+            try:
+                conn, r = icy_open(self.url)
+                metaint = int(r.getheader('icy-metaint') or 0)
+                if not metaint:
+                    print(f"{self.url} has no ICY metadata")
+                    self.unsupported = True
+                    break
+                while self.wanted():
+                    left = metaint
+                    while left:
+                        n = r.readinto(view[:min(left, len(view))])
+                        if not n: raise ConnectionError("stream ended")
+                        left -= n
+                    size = r.read(1)
+                    if not size: raise ConnectionError("stream ended")
+                    if size[0]: self.update(parse_icy(r.read(size[0] * 16)))
+            except Exception as E:
+                print(f"{self.name} metadata error: {E}")
+                time.sleep(5)
+            finally:
+                if conn: conn.close()
+        with self.lock: self.running = False
+
+    def update(self, data):
+        self.fetched = time.time()
+        if data and data != self.data:
+            self.data = data
+            metadata_changed(self)
+
+def parse_kcrw(data): return data if data.get('title') else None
+
+def parse_somafm(data):
+    songs = data.get('songs') or []
+    if not songs: return None
+    return {'artist': songs[0].get('artist', ''), 'title': songs[0].get('title', ''), 'album': songs[0].get('album', '')}
+
+def parse_kexp(data):
+    plays = data.get('results') or []
+    if not plays or plays[0].get('play_type') != 'trackplay': return None
+    return {'artist': plays[0].get('artist', ''), 'title': plays[0].get('song', ''), 'album': plays[0].get('album') or ''}
+
+metadata_providers = {}   # provider name -> MetadataProvider
+metadata_wake = threading.Event()
+
+def station_provider(station, hint=""):
+    """Find (creating on first use) the metadata provider for a station, if it has one."""
+    key = f"{station} {catalog.get(station) or ''} {hint}".lower()
+    m = re.search(r"somafm\.com/([a-z0-9]+)", key)
+    if m: name, url, parse = f"somafm:{m.group(1)}", f"https://somafm.com/songs/{m.group(1)}.json", parse_somafm
+    # KCRW_URL is Eclectic 24's tracklist; KCRW's other streams play something else
+    elif re.search(r"eclectic|(?<![a-z0-9])e24(?![a-z0-9])", key): name, url, parse = "kcrw", KCRW_URL, parse_kcrw
+    elif "kexp" in key: name, url, parse = "kexp", KEXP_URL, parse_kexp
+    # MPD reads ICY titles itself (currentsong's Title), so on mpc only a
+    # relayed stream, whose metadata the relay strips and hands over, needs one
+    elif (ICY_METADATA and re.match(r"https?://", catalog.get(station) or "") and not is_youtube_url(catalog.get(station))
+          and (BACKEND != "mpc" or relayed(catalog.get(station)))):
+        name, url, parse = "icy:" + catalog.get(station), catalog.get(station), None
+    else: return None
+    if name not in metadata_providers:
+        metadata_providers[name] = IcyProvider(name, url) if parse is None else MetadataProvider(name, url, parse)
+    return metadata_providers[name]
+
+def station_metadata(station, hint=""):
+    provider = station_provider(station, hint)
+    return provider.get() if provider else None
+
+def metadata_changed(provider):
+    # MPD doesn't know about API-side changes, so push status ourselves
+    if BACKEND == "mpc" and station_provider(current_station) is provider: push_status()
+    if BACKEND == "sonos":
+        for zone in list(zs):
+            track = broadcast.get(zone, 'track')
+            station = broadcast.get(zone, 'station') or current_station or ''
+            if track and station_provider(station, track.get('station', '')) is provider:
+                try: sonos_push_track(zone)
+                except Exception as E: print(f"Sonos refresh error on {zone}: {E}")
+
+metrics.set('not_tunein_icy_readers', lambda: sum(1 for p in list(metadata_providers.values()) if getattr(p, 'running', False)))
+
+def metadata_refresher():
+    """Refresh providers that have been asked for recently, each on its own TTL."""
+    while True:
+        now = time.time()
+        due = None
+        for provider in list(metadata_providers.values()):
+            if provider.ttl is None or now - provider.last_used > METADATA_IDLE: continue
+            if now - provider.fetched >= provider.ttl: provider.refresh()
+            nxt = provider.fetched + provider.ttl
+            due = nxt if due is None else min(due, nxt)
+        metadata_wake.clear()
+        metadata_wake.wait(None if due is None else max(1, due - time.time()))
+
+
+# Track history: plays are de-duplicated per zone and queued for a single
+# writer thread that batches them into tracks.db, so no caller waits on disk
+history_queue = queue.Queue()
+last_tracks = {}   # zone -> last recorded track
+
+def record_track(zone, track):
+    """Queue a play for the history db if it's new for this zone.  Returns True if queued."""
+    title = track.get('title') or ''
+    if title == "" or title.startswith('ZPSTR_') or str(track.get('station') or '').find("http") > -1:
+        return False
+    if title == last_tracks.get(zone, {}).get('title'): return False
+    last_tracks[zone] = dict(track)
+    if ENABLE_MQTT:
+        mqtt_publish(MQTT_TOPIC, json.dumps(track))
+        mqtt_publish(f"{MQTT_NOW_PLAYING_TOPIC}/{zone}", json.dumps(track), retain=True)
+    row = dict(track)
+    row['zone'] = zone
+    row['time'] = time.time()
+    history_queue.put(row)
+    return True
+
+def history_open():
+    from sqlite_utils import Database   # loaded on first use, off the startup path
+    return Database(HISTORY_DB)
+
+def history_db():
+    db = history_open()
+    db.enable_wal()
+    if not db['tracks'].exists():
+        db['tracks'].create({'time': float, 'zone': str, 'station': str, 'artist': str, 'title': str}, pk='time')
+    for col in ('zone', 'album', 'program'):
+        if col not in db['tracks'].columns_dict: db['tracks'].add_column(col, str)
+    for cols in (['station', 'time'], ['artist'], ['zone', 'time']):
+        db['tracks'].create_index(cols, if_not_exists=True)
+    # A replaced row (same time) must go through the delete triggers too
+    db.execute("PRAGMA recursive_triggers = ON")
+    history_rollups(db)
+    if not db['tracks_fts'].exists():
+        db['tracks'].enable_fts(HISTORY_FTS_COLUMNS, create_triggers=True)
+        print(f"Built search index over {db['tracks'].count} plays")
+    return db
+
+# Full-text search over the history: an FTS5 index on tracks, kept in sync by
+# the triggers sqlite-utils creates with it
+HISTORY_FTS_COLUMNS = ['artist', 'title', 'station', 'album', 'program']
+
+# Listening statistics: plays per day/station/artist and per day/hour/station,
+# kept current by a trigger on tracks and filled from the existing history
+# the first time, so /stats never has to scan the tracks table
+DAY = "date(new.time, 'unixepoch', 'localtime')"
+OLD_DAY = DAY.replace('new.', 'old.')
+
+def history_rollups(db):
+    backfill = not db['artist_days'].exists()
+    db.executescript(f"""
+        CREATE TABLE IF NOT EXISTS artist_days (day TEXT, station TEXT, artist TEXT, plays INTEGER NOT NULL,
+            PRIMARY KEY (day, station, artist));
+        CREATE TABLE IF NOT EXISTS station_hours (day TEXT, hour INTEGER, dow INTEGER, station TEXT, plays INTEGER NOT NULL,
+            PRIMARY KEY (day, hour, station));
+        CREATE INDEX IF NOT EXISTS idx_artist_days_station ON artist_days (station, day);
+        CREATE INDEX IF NOT EXISTS idx_station_hours_station ON station_hours (station, day);
+        CREATE TRIGGER IF NOT EXISTS tracks_rollups AFTER INSERT ON tracks BEGIN
+            INSERT INTO artist_days VALUES ({DAY}, coalesce(new.station, ''), coalesce(new.artist, ''), 1)
+                ON CONFLICT (day, station, artist) DO UPDATE SET plays = plays + 1;
+            INSERT INTO station_hours VALUES ({DAY}, CAST(strftime('%H', new.time, 'unixepoch', 'localtime') AS INTEGER),
+                CAST(strftime('%w', new.time, 'unixepoch', 'localtime') AS INTEGER), coalesce(new.station, ''), 1)
+                ON CONFLICT (day, hour, station) DO UPDATE SET plays = plays + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS tracks_rollups_delete AFTER DELETE ON tracks BEGIN
+            UPDATE artist_days SET plays = plays - 1
+                WHERE day = {OLD_DAY} AND station = coalesce(old.station, '') AND artist = coalesce(old.artist, '');
+            UPDATE station_hours SET plays = plays - 1
+                WHERE day = {OLD_DAY} AND hour = CAST(strftime('%H', old.time, 'unixepoch', 'localtime') AS INTEGER)
+                AND station = coalesce(old.station, '');
+        END;
+    """)
+    if backfill:
+        with db.conn:
+            db.execute(f"""INSERT INTO artist_days SELECT {DAY.replace('new.', '')}, coalesce(station, ''), coalesce(artist, ''), count(*)
+                           FROM tracks GROUP BY 1, 2, 3""")
+            db.execute(f"""INSERT INTO station_hours SELECT {DAY.replace('new.', '')}, CAST(strftime('%H', time, 'unixepoch', 'localtime') AS INTEGER),
+                           CAST(strftime('%w', time, 'unixepoch', 'localtime') AS INTEGER), coalesce(station, ''), count(*)
+                           FROM tracks GROUP BY 1, 2, 4""")
+        print(f"Built listening stats from {db['tracks'].count} plays")
+
+def history_writer():
+    db = history_db()
+    while True:
+        batch = [history_queue.get()]
+        # Give the rest of a burst (several zones changing at once) a moment to arrive
+        deadline = time.time() + HISTORY_FLUSH_INTERVAL
+        while len(batch) < 500:
+            try: batch.append(history_queue.get(timeout=max(0, deadline - time.time())))
+            except queue.Empty: break
+        try:
+            with db.conn, metrics.timed("history.insert"):
+                db['tracks'].insert_all(batch, pk='time', alter=True, replace=True)
+        except Exception as E:
+            print(f"History write failed ({len(batch)} rows): {E}")
+
+metrics.set('not_tunein_history_queue', history_queue.qsize)
+
 def get_status_mpc():
-    global last_track
-    ee = go("mpc")
-    if ee.find("CoreAudio") > -1: 
-        sv = get_vol_mpc()
+    ee = mpd.status()
+    if ee.get('error', '').find("CoreAudio") > -1: 
+        sv = ee.get('volume', '0')
         print(go("brew services restart mpd"))
         time.sleep(.3)
         vol_mpc(sv)
-    vv = go("mpc current")
+    song = mpd.currentsong()
+    vv = current_mpc(song)
+    stitle = song.get('Title', '')
+    if song.get('Artist') and stitle: stitle = f"{song['Artist']} - {stitle}"
     track = {}
     track['station'] = current_station
+    meta = station_metadata(current_station, vv)
     try:
-        if vv.find("[SomaFM]") > -1:
-            tracks = vv.split("[SomaFM]:")[-1]
+        if meta:
+            track.update(meta)
+            track['station'] = current_station
+        elif vv.find("[SomaFM]") > -1:
+            tracks = stitle or vv.split("[SomaFM]:")[-1]
             track['artist'] = tracks.split("-")[0].strip() 
             track['title'] = tracks.split("-")[-1].strip()
             #track['station'] = vv.split(":")[0]
-        elif vv.find("Eclectic") > -1:
-            track = requests.get(KCRW_url).json()
-            track['station'] = "KCRW E24"
         elif vv.find("WNYC") > -1:
             #track['station'] = "WNYC"
             track['program'] = vv.split(":")[-1].strip()
         else:
             #track['station'] = vv.split(":")[0]
-            tracks = vv.split(":")[-1]
+            tracks = stitle or vv.split(":")[-1]
             track['artist'] = tracks.split("-")[0].strip() 
             track['title'] = tracks.split("-")[-1].strip()
     except Exception as E: track['artist'] = str(E)
@@ -332,75 +994,952 @@ def get_status_mpc():
 
         except Exception as E: None
 
-    try: 
-        if track['title'] != last_track['title'] and track['title']!="" and track['station'].find("http") ==-1:
-            print(track)
-            track['station'] = current_station
-            track['time'] = time.time()
-            db  = Database("tracks.db")
-            db['tracks'].insert(track,pk='time')
-            db.close()
-            del(track['time']) #for alert purposes.
-            last_track = track
-
-            if ENABLE_MQTT:
-                client.connect(MQTT_BROKER,MQTT_PORT)
-                client.publish(MQTT_TOPIC,json.dumps(track))
-                client.disconnect()
-    except Exception as E: 
-        print(E)
-        last_track = track
+    if record_track('mpc', dict(track, station=current_station)):
+        track['station'] = current_station
+        print(track)
     return track
 
     
 
+# Sonos discovery runs in the background: the last known zones are served
+# from disk straight away while cached IPs are re-probed and the network rescanned
+def probe_zone(ip):
+    """Name of the zone answering at `ip`, or None."""
+    try:
+        with metrics.timed("sonos.probe"): return SoCo(ip).get_speaker_info(refresh=True, timeout=ZONE_PROBE_TIMEOUT)['zone_name']
+    except Exception: return None
+
+@metrics.timed("zones.scan")
+def scan_zones():
+    found = {}
+    with ThreadPoolExecutor(max_workers=ZONE_SCAN_WORKERS) as pool:
+        probes = [(ip, pool.submit(probe_zone, ip)) for ip in set(zs.values())]
+        scans = [pool.submit(discover, timeout=ZONE_DISCOVER_TIMEOUT)]
+        if ZONE_NETWORK_SCAN: scans.append(pool.submit(scan_network, multi_household=True, max_threads=ZONE_SCAN_WORKERS))
+        for ip, probe in probes:
+            name = probe.result()
+            if name: found[name] = ip
+        for scan in scans:
+            try: speakers = scan.result() or []
+            except Exception as E:
+                print(f"Zone scan error: {E}")
+                continue
+            names = pool.map(lambda z: (z.player_name, z.ip_address), speakers)
+            found.update(dict(names))
+    return found
+
+def load_zones():
+    try:
+        with open(ZONES_CACHE) as f: zs.update(json.load(f))
+        print(f"Loaded {len(zs)} zones from {ZONES_CACHE}")
+    except FileNotFoundError: None
+    except Exception as E: print(f"Zone cache unreadable: {E}")
+
+def save_zones():
+    tmp = ZONES_CACHE + ".tmp"
+    with open(tmp, "w") as f: json.dump(zs, f)
+    os.replace(tmp, ZONES_CACHE)
+
 def zoner():
     if BACKEND == "sonos":
-        for zone in discover(allow_network_scan=True):
-            print(zone.player_name,zone.ip_address)
-            zs[zone.player_name] = zone.ip_address
+        found = scan_zones()
+        if not found:
+            # Most likely our network is down rather than every speaker gone
+            print("No Sonos zones answered, keeping the last known zones")
+            return
+        added = {name: ip for name, ip in found.items() if zs.get(name) != ip}
+        removed = [name for name in zs if name not in found]
+        for name in removed + list(added):
+            zs.pop(name, None)
+            sonos_drop(name)
+        zs.update(added)
+        for name, ip in added.items(): print(name, ip)
+        if added or removed:
+            save_zones()
+            socketio.emit("zones", {'zones': zs, 'added': added, 'removed': removed})
+            metrics.inc('not_tunein_socketio_emits_total', event='zones')
+        sonos_subscribe_all()
     if BACKEND == "mpc": zs['mpc'] = 'mpc'
-    
-skeys = None    
+
+zone_wake = threading.Event()
+
+def zone_watcher():
+    while True:
+        try: zoner()
+        except Exception as E: print(f"Zone discovery failed: {E}")
+        zone_wake.wait(ZONE_RESCAN)
+        zone_wake.clear()
+
+class Broadcaster:
+    """Versioned per-zone state, sent to each zone's Socket.IO room as deltas.
+
+    update() merges fields into a zone's state and returns the keys that
+    changed.  A sender thread emits at most one 'delta' per zone per tick
+    ({zone, base, version, changes}) holding only the changed fields, so a
+    burst of updates costs one emit.  Clients joining a room get a full
+    'snapshot' ({zone, version, state}); a client whose version is behind a
+    delta's base has missed one and should rejoin.
+    """
+    def __init__(self, tick):
+        self.tick = tick
+        self.state = {}     # zone -> {field: value}
+        self.version = {}   # zone -> version of state
+        self.sent = {}      # zone -> version last emitted
+        self.dirty = {}     # zone -> set of fields changed since then
+        self.since = None   # when the oldest unsent change was made
+        self.cond = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self.sender, daemon=True).start()
+
+    def update(self, zone, **fields):
+        with self.cond:
+            st = self.state.setdefault(zone, {})
+            changed = {k for k, v in fields.items() if k not in st or st[k] != v}
+            if changed:
+                st.update({k: fields[k] for k in changed})
+                self.version[zone] = self.version.get(zone, 0) + 1
+                self.dirty.setdefault(zone, set()).update(changed)
+                if self.since is None: self.since = time.perf_counter()
+                self.cond.notify()
+            return changed
+
+    def get(self, zone, field, default=None):
+        with self.cond: return self.state.get(zone, {}).get(field, default)
+
+    def snapshot(self, zone):
+        with self.cond:
+            return {'zone': zone, 'version': self.version.get(zone, 0), 'state': dict(self.state.get(zone, {}))}
+
+    def sender(self):
+        while True:
+            with self.cond:
+                while not self.dirty: self.cond.wait()
+                dirty, self.dirty = self.dirty, {}
+                since, self.since = self.since, None
+                msgs = []
+                for zone, fields in dirty.items():
+                    st = self.state[zone]
+                    msgs.append({'zone': zone, 'base': self.sent.get(zone, 0), 'version': self.version[zone],
+                                 'changes': {k: st[k] for k in fields}})
+                    self.sent[zone] = self.version[zone]
+            for msg in msgs: socketio.emit('delta', msg, to=msg['zone'])
+            metrics.inc('not_tunein_socketio_emits_total', len(msgs), event='delta')
+            metrics.observe('not_tunein_broadcast_lag_seconds', time.perf_counter() - since)
+            time.sleep(self.tick)
+
+broadcast = Broadcaster(BROADCAST_TICK)
+
+# Sonos UPnP events: one AVTransport + RenderingControl subscription per zone,
+# pushed to that zone's Socket.IO room, so speaker load doesn't scale with tabs
+zone_subs = {}    # zone -> [Subscription, ...]
+_subs_lock = threading.Lock()
+
+def sonos_event(zone, event):
+    try:
+        v = event.variables
+        if 'volume' in v and 'Master' in v['volume']:
+            broadcast.update(zone, volume=int(v['volume']['Master']))
+        if 'transport_state' in v or 'current_track_meta_data' in v:
+            sonos_push_track(zone, v.get('transport_state'))
+    except Exception as E:
+        print(f"Sonos event error on {zone}: {E}")
+
+def sonos_push_track(zone, transport_state=None):
+    # The event metadata is partial for radio, so re-read the track once per
+    # change; this is shared by every client in the room
+    track = sonos_track(zone)
+    fields = {'track': track}
+    if transport_state: fields['transport_state'] = transport_state
+    if 'track' in broadcast.update(zone, **fields):
+        record_track(zone, track)
+        blink_trellis(zone, track['title'])
+
+def sonos_subscribe(zone):
+    speaker = SoCo(zs[zone])
+    subs = []
+    try:
+        for service in (speaker.avTransport, speaker.renderingControl):
+            with metrics.timed("sonos.subscribe"): sub = service.subscribe(auto_renew=True)
+            sub.callback = lambda event, zone=zone: sonos_event(zone, event)
+            sub.auto_renew_fail = lambda exc, zone=zone: sonos_resubscribe(zone, exc)
+            subs.append(sub)
+    except Exception as E:
+        for sub in subs: sonos_unsubscribe(sub)
+        sonos_resubscribe(zone, E)
+        return
+    with _subs_lock: zone_subs[zone] = subs
+    print(f"Subscribed to events for {zone}")
+
+def sonos_unsubscribe(sub):
+    try: sub.unsubscribe()
+    except Exception: None
+
+def sonos_drop(zone):
+    with _subs_lock: subs = zone_subs.pop(zone, [])
+    for sub in subs: sonos_unsubscribe(sub)
+
+def sonos_resubscribe(zone, exc, delay=30):
+    """Drop a zone's subscriptions after a failure and try again shortly."""
+    print(f"Sonos subscription for {zone} failed ({exc}), retrying in {delay}s")
+    sonos_drop(zone)
+    def retry():
+        if zone in zs and zone not in zone_subs: sonos_subscribe(zone)
+    timer = threading.Timer(delay, retry)
+    timer.daemon = True
+    timer.start()
+
+def sonos_subscribe_all():
+    pending = [zone for zone in list(zs) if zone not in zone_subs]
+    with ThreadPoolExecutor(max_workers=ZONE_SCAN_WORKERS) as pool: list(pool.map(sonos_subscribe, pending))
+
+# Station search: names and notes are folded (lower case, accents dropped)
+# and indexed by word prefix and by name trigram
+import hashlib
+import heapq
+import unicodedata
+
+def fold(text):
+    if text.isascii(): return text.lower()
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c)).lower()
+
+def trigrams(text):
+    text = f"  {text} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class StationIndex:
+    """Ranked prefix and trigram matching over a station list.
+
+    Every word of the names and notes sits in one sorted list (name words
+    and shorter names first within a word), so the rows with a word
+    starting with a prefix are a bisect away, and the same goes for whole
+    names.  A query's rarest word picks the candidates and the others are
+    checked against each candidate's words.  Typos are caught, only when
+    nothing matches by prefix, by trigrams of the distinct words of names
+    and notes: each query word is compared word for word, so one misspelt
+    word of a long name still scores well.  No step looks at more than
+    `cap` entries, so broad queries (a letter or two) stay as quick as
+    narrow ones.
+    """
+    cap = 500
+
+    def __init__(self, rows):
+        folded = [" ".join(re.findall(r"\w+", fold(name))) for name, _, _ in rows]
+        self.names = sorted((name, len(name), i) for i, name in enumerate(folded))
+        self.name_keys = [n for n, _, _ in self.names]
+        self.lengths = [len(name) for name in folded]
+        self.row_words = []   # row -> (name words, notes words)
+        self.vocab = {}       # word of any name or notes -> its trigrams
+        self.postings = {}    # trigram -> words that have it
+        words = []
+        for i, name in enumerate(folded):
+            in_name = set(name.split())
+            in_notes = set(re.findall(r"\w+", fold(rows[i][2]))) - in_name
+            self.row_words.append((in_name, in_notes))
+            words += [(w, 0, len(name), i) for w in in_name]
+            words += [(w, 1, len(name), i) for w in in_notes]
+            for w in in_name | in_notes:
+                if w in self.vocab: continue
+                self.vocab[w] = trigrams(w)
+                for g in self.vocab[w]: self.postings.setdefault(g, []).append(w)
+        words.sort()
+        self.words = words
+        self.word_keys = [w for w, _, _, _ in words]
+
+    def prefixed(self, keys, prefix):
+        lo = bisect.bisect_left(keys, prefix)
+        return lo, bisect.bisect_left(keys, prefix + "￿", lo)
+
+    def spelled_like(self, w):
+        """{word: similarity} for indexed words sharing enough trigrams with w."""
+        grams = trigrams(w)
+        hits = {}
+        for g in grams:
+            for x in self.postings.get(g, ())[:self.cap]: hits[x] = hits.get(x, 0) + 1
+        out = {}
+        for x, n in hits.items():
+            similarity = n / len(grams | self.vocab[x])
+            if n >= min(2, len(grams)) and similarity >= 0.3: out[x] = similarity
+        return out
+
+    def search(self, q, limit=20):
+        """[(score, row)] best first: the whole name (100), the start of the
+        name (90), every word of q starting a word of the name (80) or of the
+        name and notes (60), then every word of q spelled like a word of the
+        name or notes (up to 50, less for notes)."""
+        q = " ".join(re.findall(r"\w+", fold(q)))
+        if not q: return []
+        scores = {}
+        lo, hi = self.prefixed(self.name_keys, q)
+        for name, _, i in self.names[lo:min(hi, lo + self.cap)]: scores[i] = 100 if name == q else 90
+        ranges = sorted((self.prefixed(self.word_keys, w) + (w,) for w in set(q.split())), key=lambda r: r[1] - r[0])
+        lo, hi, _ = ranges[0]
+        rest = [w for _, _, w in ranges[1:]]
+        for _, notes, _, i in self.words[lo:min(hi, lo + self.cap)]:
+            if i in scores: continue
+            if not rest:
+                scores[i] = 60 if notes else 80
+                continue
+            in_name, in_notes = self.row_words[i]
+            where = [0 if any(x.startswith(w) for x in in_name) else 1 if any(x.startswith(w) for x in in_notes) else None for w in rest]
+            if None not in where: scores[i] = 60 if notes or 1 in where else 80
+        if not scores:
+            # Candidates come from the words spelled like q's rarest-looking word
+            alike = sorted((self.spelled_like(w) for w in set(q.split())), key=len)
+            if not alike[0]: alike = []
+            for x in sorted(alike[0], key=alike[0].get, reverse=True) if alike else ():
+                lo = bisect.bisect_left(self.word_keys, x)
+                hi = bisect.bisect_right(self.word_keys, x, lo)
+                for _, _, _, i in self.words[lo:min(hi, lo + self.cap)]:
+                    if i in scores: continue
+                    in_name, in_notes = self.row_words[i]
+                    best = [max([sims.get(y, 0) for y in in_name] + [sims.get(y, 0) * .75 for y in in_notes]) for sims in alike]
+                    if all(best): scores[i] = round(50 * sum(best) / len(best), 1)
+                if len(scores) >= self.cap: break
+        best = heapq.nsmallest(limit, scores.items(), key=lambda s: (-s[1], self.lengths[s[0]], s[0]))
+        return [(score, i) for i, score in best]
+
+class StationCatalog:
+    """The station sheet (name, url, notes per row), cached on disk.
+
+    Boot loads the last copy from disk, and refreshes are conditional GETs
+    against the sheet.  All lookups read one snapshot tuple that a refresh
+    replaces in a single assignment, so readers never see a half-built list.
+    Things derived from a list (its search index, its version for ETags)
+    are built on first use and kept in that list's snapshot.
+    """
+    def __init__(self, url, path):
+        self.url = url
+        self.path = path
+        self.etag = None
+        self.modified = None
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+        self._set([])
+
+    def _set(self, rows):
+        stations = {}
+        notes = {}
+        for name, url, note in rows:
+            stations[name] = url
+            notes[name] = note
+        names = list(stations)
+        self.snap = (stations, names, {n: i for i, n in enumerate(names)}, notes, rows, {})
+
+    def derived(self, key, build, snap=None):
+        """build(rows) for a snapshot (the current one by default), computed once."""
+        snap = snap or self.snap
+        cache = snap[5]
+        if key not in cache:
+            with self.build_lock:
+                if key not in cache: cache[key] = build(snap[4])
+        return cache[key]
+
+    def version(self, snap=None):
+        return self.derived('version', lambda rows: hashlib.sha1(json.dumps(rows).encode()).hexdigest()[:16], snap)
+
+    def prepare(self):
+        """Build the current list's search index and version ahead of the first request."""
+        self.derived('index', StationIndex)
+        self.version()
+
+    def search(self, q, limit=20, snap=None):
+        """[(score, name)] for the stations best matching q."""
+        snap = snap or self.snap
+        index = self.derived('index', StationIndex, snap)
+        found = {}
+        for score, i in index.search(q, limit):
+            found.setdefault(snap[4][i][0], score)   # a name listed twice is one station
+        return [(score, name) for name, score in found.items()]
+
+    @staticmethod
+    def parse(tsv):
+        rows = []
+        lines = tsv.split("\n")
+        lines.pop(0) #assume title, url, notes 
+        for r in lines:
+            p = r.rstrip("\r").split("\t")
+            if len(p) < 2 or not p[0].strip(): continue
+            rows.append((p[0].strip(), p[1].strip(), "\t".join(p[2:]).strip()))
+        return rows
+
+    @property
+    def stations(self): return self.snap[0]
+
+    @property
+    def names(self): return self.snap[1]
+
+    @property
+    def notes(self): return self.snap[3]
+
+    def __len__(self): return len(self.snap[1])
+
+    def get(self, name): return self.snap[0].get(name)
+
+    def index(self, name): return self.snap[2].get(name)
+
+    def at(self, idx):
+        """(name, url) for a position, from one snapshot."""
+        stations, names = self.snap[:2]
+        return names[idx], stations[names[idx]]
+
+    def step(self, name, delta, skip=None):
+        """(index, name, url) of the station `delta` places from `name`, wrapping around.
+
+        Stations for which skip(name, url) is true are stepped over, unless
+        that would skip every station.
+        """
+        stations, names, index = self.snap[:3]
+        idx = index.get(name)
+        if idx is None: idx = -1 if delta > 0 else 0
+        step = 1 if delta > 0 else -1
+        first = idx = (idx + delta) % len(names)
+        while skip and skip(names[idx], stations[names[idx]]):
+            idx = (idx + step) % len(names)
+            if idx == first: break
+        return idx, names[idx], stations[names[idx]]
+
+    def load(self):
+        try:
+            with open(self.path) as f: cached = json.load(f)
+            self.etag = cached.get('etag')
+            self.modified = cached.get('modified')
+            self._set(self.parse(cached['tsv']))
+            return True
+        except FileNotFoundError: return False
+        except Exception as E:
+            print(f"Station cache unreadable: {E}")
+            return False
+
+    def save(self, tsv):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f: json.dump({'url': self.url, 'etag': self.etag, 'modified': self.modified, 'tsv': tsv}, f)
+        os.replace(tmp, self.path)
+
+    @metrics.timed("stations.refresh")
+    def refresh(self):
+        """Re-fetch the sheet if it changed.  Returns True if the station list changed."""
+        with self.lock:
+            headers = {}
+            if self.etag: headers['If-None-Match'] = self.etag
+            if self.modified: headers['If-Modified-Since'] = self.modified
+            r = http.get(self.url, headers=headers, timeout=STATIONS_TIMEOUT)
+            if r.status_code == 304: return False
+            r.raise_for_status()
+            rows = self.parse(r.text)
+            if not rows: raise ValueError("station list is empty")
+            self.etag = r.headers.get('ETag')
+            self.modified = r.headers.get('Last-Modified')
+            changed = rows != self.snap[4]
+            if changed: self._set(rows)
+            self.save(r.text)
+            return changed
+
+catalog = StationCatalog(STATIONSCSV, STATIONS_CACHE)
+
 def stationer():
-    global skeys
-    skeys = None
-    surl = STATIONSCSV
-    rs = requests.get(surl).text.split("\n")
-    rs.pop(0) #assume title, url, notes 
-    for r in rs:
+    try:
+        if catalog.refresh():
+            print(f"Loaded {len(catalog)} stations")
+            catalog.prepare()
+            socketio.emit("stations", catalog.stations)
+            metrics.inc('not_tunein_socketio_emits_total', event='stations')
+            youtube_wake.set()
+            health_wake.set()
+    except Exception as E:
+        print(f"Station list refresh failed, keeping {len(catalog)} cached stations: {E}")
+
+def station_refresher():
+    catalog.prepare()
+    while True:
+        stationer()
+        time.sleep(STATIONS_REFRESH)
+
+# Station health: every stream in the catalog is probed in the background
+# (connect time, time to the first audio bytes, ICY bitrate) so stepping
+# through stations can skip the ones that are down
+station_health = {}   # url -> {ok, failures, connect_ms, first_byte_ms, bitrate, content_type, error, checked}
+health_wake = threading.Event()
+
+def probe_station(url):
+    """Open a stream, read its first bytes and report how that went."""
+    result = {'ok': False, 'connect_ms': None, 'first_byte_ms': None, 'bitrate': None, 'content_type': None, 'error': None}
+    start = time.perf_counter()
+    conn = None
+    try:
+        # icy_open, so SHOUTcast v1's "ICY 200 OK" gets its headers read too
+        with metrics.timed("station.probe"):
+            conn, r = icy_open(url, timeout=STATION_PROBE_TIMEOUT)
+            result['connect_ms'] = round(conn.connect_s * 1000, 1)
+            result['content_type'] = r.getheader('Content-Type')
+            br = r.getheader('icy-br') or r.getheader('ice-audio-info', '')
+            m = re.search(r"(\d+)", br.split("bitrate=")[-1]) if br else None
+            if m: result['bitrate'] = int(m.group(1))
+            if not r.read(1): raise ValueError("stream sent no data")
+            result['first_byte_ms'] = round((time.perf_counter() - start) * 1000, 1)
+            result['ok'] = True
+    except Exception as E: result['error'] = str(E)[:200]
+    finally:
+        if conn: conn.close()
+    return result
+
+def check_station(url):
+    result = probe_station(url)
+    old = station_health.get(url, {})
+    result['failures'] = 0 if result['ok'] else old.get('failures', 0) + 1
+    result['checked'] = time.time()
+    station_health[url] = result
+    return result
+
+def station_dead(name, url):
+    """True if the last STATION_DEAD_AFTER probes of this station all failed."""
+    return station_health.get(url, {}).get('failures', 0) >= STATION_DEAD_AFTER
+
+def health_prober():
+    while True:
+        urls = {u for u in catalog.stations.values() if not is_youtube_url(u)}
+        with ThreadPoolExecutor(max_workers=STATION_PROBE_WORKERS) as pool: list(pool.map(check_station, urls))
+        for url in list(station_health):
+            if url not in urls: station_health.pop(url, None)
+        dead = [n for n, u in catalog.stations.items() if station_dead(n, u) and not is_youtube_url(u)]
+        if dead: print(f"Stations down: {', '.join(dead)}")
+        health_wake.clear()
+        health_wake.wait(STATION_PROBE_INTERVAL)
+
+# Stream relay: each station being relayed is pulled once into an in-memory
+# ring and served from there to every speaker and browser at /relay/<station>.
+# Expiring sources (YouTube) are re-resolved behind the stable local URL, and
+# the upstream is dropped RELAY_IDLE seconds after the last listener leaves.
+# With TIMESHIFT the ring is a memory-mapped file holding that many minutes,
+# so zones can pause and rewind without losing the broadcast
+from array import array
+import mmap
+
+relays = {}   # station -> Relay
+relays_lock = threading.Lock()
+ring_paths = set()   # time-shift ring files in use
+
+class Relay:
+    """One upstream connection for a station, shared by all its listeners.
+
+    The pump thread reads straight into a ring buffer (`readinto` on slices
+    of one memoryview, so audio isn't copied on the way in).  `written`
+    counts every byte ever received; a listener is just a position in that
+    count, so a slow one only holds up itself.  One that falls more than
+    a buffer behind skips ahead to the live edge, and a source that's
+    faster than real time (a YouTube file) is paced by the leading listener.
+    ICY metadata is stripped out and handed to the station's IcyProvider.
+
+    A source with a Content-Length is a file, not a broadcast: nothing is
+    read until someone listens, listeners start at its first byte (so they
+    get the container header) and it ends instead of starting over.  Once
+    that first byte has left the buffer relay_for starts a new relay.
+
+    With TIMESHIFT the ring is a file in TIMESHIFT_DIR sized for TIMESHIFT
+    minutes at TIMESHIFT_KBPS, mapped rather than read, so memory use
+    doesn't grow with it.  An index with one slot per second (the
+    `written` count when that second's audio started) makes finding a
+    point in time one lookup.  Paused zones hold the relay open.
+    """
+    chunk = 4096
+
+    def __init__(self, station, url):
+        self.station = station
+        self.url = url
+        self.path = None
+        if TIMESHIFT:
+            os.makedirs(TIMESHIFT_DIR, exist_ok=True)
+            self.path = os.path.join(TIMESHIFT_DIR, quote(station, safe='') + ".ring")
+            n = 1
+            while self.path in ring_paths:   # a relay this one replaces is still playing out
+                self.path = os.path.join(TIMESHIFT_DIR, f"{quote(station, safe='')}.{n}.ring")
+                n += 1
+            ring_paths.add(self.path)
+            size = TIMESHIFT * 60 * TIMESHIFT_KBPS * 125
+            with open(self.path, "w+b") as f:
+                f.truncate(size)
+                self.ring = mmap.mmap(f.fileno(), size)
+        else: self.ring = bytearray(RELAY_BUFFER)
+        self.view = memoryview(self.ring)
+        self.margin = min(len(self.ring) // 4, 64 * 1024)   # never read this close behind the pump
+        self.written = 0
+        self.positions = {}   # listener -> bytes read so far
+        self.holds = set()    # zones paused on this station
+        slots = TIMESHIFT * 60
+        self.index_sec = array('q', [-1]) * slots   # the second each slot was last filled for
+        self.index_pos = array('q', [0]) * slots    # `written` when that second started
+        self.last_sec = None
+        self.cond = threading.Condition()
+        self.running = False
+        self.ready = threading.Event()
+        self.content_type = None
+        self.finite = False   # a file (it has a length), not a live stream
+        self.ended = False    # ...and all of it has been read
+        self.idle_since = time.time()
+
+    def start(self):
+        with self.cond:
+            self.idle_since = time.time()
+            if self.running: return
+            self.running = True
+        threading.Thread(target=self.pump, daemon=True).start()
+
+    def wanted(self):
+        return bool(self.positions or self.holds) or time.time() - self.idle_since < RELAY_IDLE
+
+    def stop_if_idle(self):
+        with relays_lock, self.cond:
+            if self.wanted(): return False
+            self.running = False
+            self.cond.notify_all()
+            if relays.get(self.station) is self: relays.pop(self.station)
+        if self.path:
+            ring_paths.discard(self.path)
+            try: os.remove(self.path)
+            except OSError: None
+        return True
+
+    def spent(self):
+        """True for a file whose start is no longer buffered, which a new listener can't join."""
+        return self.finite and self.oldest() > 0
+
+    def release(self, zone):
+        """Let go of a paused zone's hold; the relay stays up RELAY_IDLE longer."""
+        with self.cond:
+            self.holds.discard(zone)
+            self.idle_since = time.time()
+
+    def oldest(self):
+        return max(0, self.written - len(self.ring) + self.margin)
+
+    def offset_at(self, t):
+        """Where the audio received at unix time t starts, clamped to what's
+        still buffered; None for now or later (the live edge)."""
+        now = int(time.time())
+        slots = len(self.index_sec)
+        if not slots or t >= now: return None
+        sec = max(int(t), now - slots + 1)
+        with self.cond:
+            # Seconds with nothing indexed (before the relay started, or while
+            # the upstream was reconnecting) resolve to the next one that has
+            for s in range(sec, min(now, sec + 60)):
+                if self.index_sec[s % slots] == s: return max(self.oldest(), self.index_pos[s % slots])
+            return None if sec >= (self.last_sec or 0) else self.oldest()
+
+    def pump(self):
+        size = len(self.ring)
+        offset = 0   # bytes of a resumable source already relayed
+        failures = 0
+        while not self.stop_if_idle():
+            if self.ended:
+                with self.cond: self.cond.wait(1)
+                continue
+            conn = None
+            try:
+                url = get_youtube_stream_url(self.url) if is_youtube_url(self.url) else self.url
+                if not url: raise ValueError("could not resolve stream URL")
+                with metrics.timed("relay.connect"):
+                    conn, r = icy_open(url, metadata=ICY_METADATA and not is_youtube_url(self.url), offset=offset)
+                # Files (anything with a length) can be resumed where they broke off
+                self.finite = r.getheader('Content-Length') is not None
+                if r.status != 206 and offset:
+                    # The server ignored the range, so skip what was relayed already
+                    skip = offset
+                    while skip:
+                        n = len(r.read(min(skip, 65536)))
+                        if not n: raise ConnectionError("stream ended")
+                        skip -= n
+                self.content_type = r.getheader('Content-Type') or 'audio/mpeg'
+                self.ready.set()
+                failures = 0
+                metaint = int(r.getheader('icy-metaint') or 0)
+                left = metaint
+                # Live streams are read as they come; a file only as far
+                # ahead of its leading listener as the buffer allows
+                paced = lambda: (self.positions and self.written + self.chunk - max(self.positions.values()) <= size - self.margin
+                                 or not self.positions and not self.finite)
+                while self.wanted():
+                    with self.cond:
+                        if not self.cond.wait_for(paced, timeout=1): continue
+                    pos = self.written % size
+                    n = r.readinto(self.view[pos:pos + min(self.chunk, size - pos, left or self.chunk)])
+                    if not n and self.finite and not r.length:   # all of it, not a dropped connection
+                        with self.cond:
+                            self.ended = True
+                            self.cond.notify_all()
+                        break
+                    if not n: raise ConnectionError("stream ended")
+                    if self.finite: offset += n
+                    with self.cond:
+                        sec = int(time.time())
+                        if sec != self.last_sec and self.index_sec:
+                            self.index_sec[sec % len(self.index_sec)] = sec
+                            self.index_pos[sec % len(self.index_sec)] = self.written
+                            self.last_sec = sec
+                        self.written += n
+                        self.cond.notify_all()
+                    metrics.inc('not_tunein_relay_bytes_total', n, direction='in')
+                    if metaint:
+                        left -= n
+                        if not left:
+                            length = r.read(1)
+                            if not length: raise ConnectionError("stream ended")
+                            if length[0]:
+                                provider = metadata_providers.get("icy:" + self.url)
+                                block = r.read(length[0] * 16)
+                                if provider: provider.update(parse_icy(block))
+                            left = metaint
+            except Exception as E:
+                print(f"Relay {self.station}: {E}")
+                failures += 1
+                time.sleep(min(30, failures - 1))
+            finally:
+                if conn: conn.close()
+
+    def listen(self, start=None):
+        """The stream from `start` (a `written` count, e.g. from offset_at) or
+        just behind the live edge, as bytes chunks for a WSGI response."""
+        size = len(self.ring)
+        me = object()
+        with self.cond:
+            if start is not None: pos = max(self.oldest(), min(start, self.written))
+            elif self.finite: pos = self.oldest()   # 0 unless spent; relay_for replaces those
+            else: pos = max(0, self.written - RELAY_PREROLL)
+            self.positions[me] = pos
+        self.start()
         try:
-            p = r.split("\t")
-            stations[p[0].strip()] = p[1]
-        except Exception as E: None
-    skeys = list(stations.keys())
+            while True:
+                with self.cond:
+                    self.positions[me] = pos
+                    self.cond.notify_all()
+                    if not self.cond.wait_for(lambda: self.written > pos or self.ended or not self.running, timeout=RELAY_TIMEOUT): return
+                    if self.written <= pos: return
+                    if self.written - pos > size - self.margin:
+                        metrics.inc('not_tunein_relay_skips_total')
+                        pos = max(0, self.written - RELAY_PREROLL)
+                    start = pos % size
+                    end = start + min(self.written - pos, size - start)
+                    # WSGI wants bytes, so this is the one copy per listener;
+                    # taken under the lock, the pump never writes this region
+                    chunk = bytes(self.view[start:end])
+                pos += len(chunk)
+                metrics.inc('not_tunein_relay_bytes_total', len(chunk), direction='out')
+                yield chunk
+        finally:
+            with self.cond:
+                self.positions.pop(me, None)
+                self.idle_since = time.time()
+                self.cond.notify_all()
+
+def relay_for(station, url):
+    """The running relay for a station, started if need be."""
+    with relays_lock:
+        relay = relays.get(station)
+        if relay is None or relay.url != url or relay.spent(): relay = relays[station] = Relay(station, url)
+    relay.start()
+    return relay
+
+def relay_ready(station):
+    relay = relays.get(station)
+    return bool(relay and relay.ready.is_set())
+
+def relayed(url):
+    return any(r.running and r.url == url for r in list(relays.values()))
+
+def relay_url(host, station, at=None):
+    """The station's relay URL as seen from host (a speaker or the MPD server),
+    starting at unix time `at` in the time-shift buffer if given."""
+    ip = "127.0.0.1"
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect((host, 1400))   # picks the interface that routes there; nothing is sent
+            ip = s.getsockname()[0]
+    except OSError: None
+    return f"http://{ip}:{PORT}/relay/{quote(station, safe='')}" + (f"?t={at:.1f}" if at else "")
+
+metrics.set('not_tunein_relay_listeners', lambda: sum(len(r.positions) for r in list(relays.values())))
 
-zoner()
 
-stationer()
+import gzip
+import mimetypes
+from flask import Response
+from werkzeug.security import safe_join
+try: import brotli
+except ImportError: brotli = None
+
+class StaticAssets:
+    """Files under STATIC_DIR, read, hashed and compressed once.
+
+    Each file is kept in memory with its content hash and gzip/brotli
+    variants, and is only re-read when its mtime changes.  Pages have their
+    /static/ references rewritten to ?v=<hash> URLs, which are served as
+    immutable; everything else revalidates with the hash as ETag.
+    """
+    compressible = ('text/', 'application/javascript', 'application/json', 'image/svg+xml', 'image/x-icon', 'image/vnd.microsoft.icon')
+    ref = re.compile(r'((?:src|href)=["\'])/static/([^"\'?#]+)')
+
+    def __init__(self, root):
+        self.root = root
+        self.files = {}
+        self.lock = threading.RLock()
+
+    def _build(self, body, mtime, mimetype, deps=()):
+        tag = hashlib.sha1(body).hexdigest()[:16]
+        variants = {'identity': body}
+        if len(body) >= STATIC_MIN_COMPRESS and mimetype.startswith(self.compressible):
+            gz = gzip.compress(body, 9, mtime=0)
+            if len(gz) < len(body): variants['gzip'] = gz
+            if brotli:
+                br = brotli.compress(body)
+                if len(br) < len(body): variants['br'] = br
+        return {'mtime': mtime, 'hash': tag, 'mimetype': mimetype, 'variants': variants, 'deps': deps}
+
+    def get(self, name, page=False):
+        """Cached entry for `name`, or None if there is no such file."""
+        path = safe_join(self.root, name)
+        if path is None: return None
+        try: mtime = os.stat(path).st_mtime_ns
+        except OSError: return None
+        key = (name, page)
+        entry = self.files.get(key)
+        if entry and entry['mtime'] == mtime and all(self.url(d) == u for d, u in entry['deps']): return entry
+        with self.lock:
+            if not os.path.isfile(path): return None
+            with open(path, 'rb') as f: body = f.read()
+            mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            deps = ()
+            if page:
+                # Point the page at hashed URLs, and remember them so a changed asset re-renders it
+                text = body.decode('utf-8')
+                deps = tuple((d, self.url(d)) for d in sorted(set(m.group(2) for m in self.ref.finditer(text))))
+                urls = dict(deps)
+                body = self.ref.sub(lambda m: m.group(1) + urls[m.group(2)], text).encode('utf-8')
+                mimetype = 'text/html'
+            entry = self._build(body, mtime, mimetype, deps)
+            self.files[key] = entry
+            return entry
+
+    def url(self, name):
+        entry = self.get(name)
+        return f"/static/{name}?v={entry['hash']}" if entry else f"/static/{name}"
+
+    def preload(self):
+        for folder, _, files in os.walk(self.root):
+            for f in files: self.get(os.path.relpath(os.path.join(folder, f), self.root).replace(os.sep, '/'))
+
+    def response(self, name, page=False):
+        entry = self.get(name, page)
+        if entry is None: return "Not found", 404
+        accept = request.accept_encodings
+        encoding = next((e for e in ('br', 'gzip') if e in entry['variants'] and accept[e]), 'identity')
+        etag = entry['hash'] if encoding == 'identity' else f"{entry['hash']}-{encoding}"
+        if page: cache = 'no-cache'
+        elif request.args.get('v') == entry['hash']: cache = 'public, max-age=31536000, immutable'
+        else: cache = 'no-cache'
+        headers = {'ETag': f'"{etag}"', 'Cache-Control': cache, 'Vary': 'Accept-Encoding'}
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+        body = entry['variants'][encoding]
+        if encoding != 'identity': headers['Content-Encoding'] = encoding
+        return Response(body, mimetype=entry['mimetype'], headers=headers)
+
+assets = StaticAssets(STATIC_DIR)
+
+@app.route('/static/<path:name>')
+def static_file(name): return assets.response(name)
 
 @app.route('/')
-def index(): return open("static/index.html").read()
+def index(): return assets.response("index.html", page=True)
 
 @app.route('/local')
-def local(): return open("static/pindex.html").read()
+def local(): return assets.response("pindex.html", page=True)
+
 
+@app.route('/metrics')
+def metrics_endpoint(): return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/get_zone')
 def get_zones(): return jsonify(zs)
 
 @app.route('/get_station')
-def get_stations(): return jsonify(stations)
+def get_stations(): return jsonify(catalog.stations)
+
+@app.route('/stations')
+def stations_page():
+    """The station list a page at a time, in sheet order.
+
+    limit (default 100, at most 1000) and cursor (the previous page's
+    `next`).  A cursor names the last station sent, so paging carries on
+    from the right place if the sheet changes in between.
+    """
+    snap = catalog.snap
+    stations, names, index, notes = snap[:4]
+    etag = catalog.version(snap)
+    if request.if_none_match.contains(etag): return Response(status=304, headers={'ETag': f'"{etag}"'})
+    try:
+        limit = max(1, min(int(request.args.get('limit', 100)), 1000))
+        start = 0
+        if request.args.get('cursor'):
+            after, pos = history_cursor(token=request.args['cursor'])
+            start = (index[after] if after in index else min(int(pos), len(names) - 1)) + 1
+    except (ValueError, TypeError) as E: return jsonify({'error': f"bad argument: {E}"}), 400
+    page = names[start:start + limit]
+    out = {'stations': [{'station': n, 'url': stations[n], 'notes': notes[n], 'index': start + i} for i, n in enumerate(page)],
+           'next': history_cursor([page[-1], start + len(page) - 1]) if page and start + limit < len(names) else None,
+           'total': len(names)}
+    response = jsonify(out)
+    response.headers.update({'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'})
+    return response
+
+@app.route('/stations/search')
+def stations_search():
+    """Stations matching q (names and notes; words are prefixes, near misses
+    count), best first, at most limit (default 20, at most 100)."""
+    q = request.args.get('q', '')
+    if not q.strip(): return jsonify({'error': 'q is required'}), 400
+    try: limit = max(1, min(int(request.args.get('limit', 20)), 100))
+    except ValueError as E: return jsonify({'error': f"bad argument: {E}"}), 400
+    snap = catalog.snap
+    etag = catalog.version(snap)
+    if request.if_none_match.contains(etag): return Response(status=304, headers={'ETag': f'"{etag}"'})
+    stations, index, notes = snap[0], snap[2], snap[3]
+    results = [{'station': n, 'url': stations[n], 'notes': notes[n], 'index': index[n], 'score': score}
+               for score, n in catalog.search(q, limit, snap)]
+    response = jsonify({'results': results})
+    response.headers.update({'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'})
+    return response
+
+@app.route('/station_health')
+def get_station_health():
+    """Probe results per station, fastest first; stations not probed yet come last."""
+    out = []
+    for name, url in catalog.stations.items():
+        h = station_health.get(url, {})
+        out.append(dict(h, station=name, dead=station_dead(name, url)))
+    out.sort(key=lambda h: (h['dead'], h.get('first_byte_ms') is None, h.get('first_byte_ms') or 0))
+    return jsonify(out)
+
+@app.route('/relay/<path:station>')
+def relay_station(station):
+    """The station's stream through the shared relay, for speakers and browsers alike."""
+    url = catalog.get(station)
+    if not url: return jsonify({'error': 'unknown station'}), 404
+    try: at = float(request.args['t']) if request.args.get('t') else None
+    except ValueError: return jsonify({'error': 't must be a unix time'}), 400
+    relay = relay_for(station, url)
+    if not relay.ready.wait(RELAY_TIMEOUT): return jsonify({'error': 'station not reachable'}), 504
+    return Response(relay.listen(None if at is None else relay.offset_at(at)), mimetype=relay.content_type, headers={'Cache-Control': 'no-cache'})
 
 @app.route('/rezone')
 def rezone():
-    zoner()
+    # Rescans in the background; changes are pushed as a 'zones' event
+    zone_wake.set()
     return jsonify(zs)
 
 @app.route('/restation')
 def restation():
     stationer()
-    return jsonify(stations)
+    return jsonify(catalog.stations)
 
 @app.route('/mpc_status')
 def mpc_status():
@@ -412,9 +1951,33 @@ def mpc_status():
 # Track blinking state for alternating colors
 _blink_toggle = False
 
+def blink_trellis(zone, title):
+    """Blink the station button orange/green while the zone is buffering/connecting."""
+    global _blink_toggle
+    # NeoTrellis buttons 0-11 are for stations
+    if ENABLE_MQTT and current_station_idx is not None and current_station_idx <= 11:
+        if title.startswith('ZPSTR_BUFFERING') or title.startswith('ZPSTR_CONNECTING'):
+            _blink_toggle = not _blink_toggle
+            if _blink_toggle:
+                send_trellis_light(zone, current_station_idx, [255, 165, 0], 1000)  # orange
+            else:
+                send_trellis_light(zone, current_station_idx, [0, 255, 0], 1000)  # green
+
+def sonos_track(zone):
+    track = {}
+    with metrics.timed("sonos.get_current_track_info"): track_info = SoCo(zs[zone]).get_current_track_info()
+    track['artist'] = track_info.get('artist', '')
+    track['title'] = track_info.get('title', '')
+    track['album'] = track_info.get('album', '')
+    station = broadcast.get(zone, 'station') or current_station or ''
+    track['station'] = track_info.get('radio_show', station)
+    track['uri'] = track_info.get('uri', '')
+    meta = station_metadata(station, track['station'])
+    if meta: track.update({k: meta[k] for k in ('artist', 'title', 'album') if meta.get(k)})
+    return track
+
 @app.route('/track_status', methods=['POST', 'GET'])
 def track_status():
-    global _blink_toggle
     track = {}
     if BACKEND == "mpc":
         track = get_status_mpc()
@@ -423,23 +1986,13 @@ def track_status():
             data = request.json if request.method == 'POST' else request.args
             zone = data.get('zone')
             if zone and zone in zs:
-                track_info = SoCo(zs[zone]).get_current_track_info()
-                track['artist'] = track_info.get('artist', '')
-                track['title'] = track_info.get('title', '')
-                track['album'] = track_info.get('album', '')
-                track['station'] = track_info.get('radio_show', current_station or '')
-                track['uri'] = track_info.get('uri', '')
-
-                # Blink station button orange/green when buffering/connecting
-                # NeoTrellis buttons 0-11 are for stations
-                if ENABLE_MQTT and current_station_idx is not None and current_station_idx <= 11:
-                    title = track['title']
-                    if title.startswith('ZPSTR_BUFFERING') or title.startswith('ZPSTR_CONNECTING'):
-                        _blink_toggle = not _blink_toggle
-                        if _blink_toggle:
-                            send_trellis_light(zone, current_station_idx, [255, 165, 0], 1000)  # orange
-                        else:
-                            send_trellis_light(zone, current_station_idx, [0, 255, 0], 1000)  # green
+                if broadcast.get(zone, 'track'):
+                    # Kept current by the zone's event subscription
+                    track = dict(broadcast.get(zone, 'track'))
+                else:
+                    track = sonos_track(zone)
+                    record_track(zone, track)
+                blink_trellis(zone, track['title'])
             else:
                 track['error'] = 'Zone not specified or not found'
         except Exception as E:
@@ -449,15 +2002,625 @@ def track_status():
 
     return jsonify(track)
 
-
+@app.route('/now_playing')
+def now_playing():
+    station = request.args.get('station', current_station or '')
+    return jsonify(station_metadata(station) or {})
+
+def stats_day(value):
+    """YYYY-MM-DD from a date or a unix time."""
+    if re.fullmatch(r"\d+(\.\d*)?", value): return time.strftime("%Y-%m-%d", time.localtime(float(value)))
+    return time.strftime("%Y-%m-%d", time.strptime(value, "%Y-%m-%d"))
+
+STATS_QUERIES = {
+    'artist': "SELECT artist, sum(plays) AS plays FROM artist_days WHERE artist != '' AND {where} GROUP BY artist ORDER BY plays DESC LIMIT ?",
+    'station': "SELECT station, sum(plays) AS plays FROM station_hours WHERE {where} GROUP BY station ORDER BY plays DESC LIMIT ?",
+    'day': "SELECT day, sum(plays) AS plays FROM station_hours WHERE {where} GROUP BY day ORDER BY day DESC LIMIT ?",
+    'hour': "SELECT dow, hour, sum(plays) AS plays FROM station_hours WHERE {where} GROUP BY dow, hour ORDER BY dow, hour LIMIT ?",
+}
+
+@app.route('/stats')
+def stats():
+    """Play counts from the rollups.
+
+    by: artist (top artists), station, day or hour (hour of the week, dow 0 = Sunday);
+    station, artist: filters; since/until: inclusive days, YYYY-MM-DD or unix time; limit.
+    """
+    by = request.args.get('by', 'artist')
+    if by not in STATS_QUERIES: return jsonify({'error': f"by must be one of {', '.join(STATS_QUERIES)}"}), 400
+    where, params = ["1"], []
+    try:
+        if request.args.get('since'): where.append("day >= ?"); params.append(stats_day(request.args['since']))
+        if request.args.get('until'): where.append("day <= ?"); params.append(stats_day(request.args['until']))
+        limit = int(request.args.get('limit', 168 if by == 'hour' else 50))
+    except ValueError as E: return jsonify({'error': str(E)}), 400
+    if request.args.get('station'): where.append("station = ?"); params.append(request.args['station'])
+    query = STATS_QUERIES[by]
+    if request.args.get('artist'):
+        if by == 'hour': return jsonify({'error': "hourly stats aren't kept per artist"}), 400
+        where.append("artist = ?"); params.append(request.args['artist'])
+        query = query.replace("FROM station_hours", "FROM artist_days")
+    db = history_open()
+    try:
+        rows = db.execute(query.format(where=" AND ".join(where)), params + [limit])
+        cols = [c[0] for c in rows.description]
+        return jsonify([dict(zip(cols, r)) for r in rows.fetchall()])
+    finally: db.close()
+
+def history_time(value, end=False):
+    """Unix time from a unix time or a YYYY-MM-DD day (its start, or with end its end)."""
+    if re.fullmatch(r"\d+(\.\d*)?", value): return float(value)
+    t = time.strptime(value, "%Y-%m-%d")
+    return time.mktime((t.tm_year, t.tm_mon, t.tm_mday + (1 if end else 0), 0, 0, 0, 0, 0, -1))
+
+def history_filters(args, table="tracks"):
+    """SQL conditions and params for the station/zone/since/until arguments of a history query."""
+    where, params = [], []
+    for col in ('station', 'zone'):
+        if args.get(col):
+            where.append(f"{table}.{col} = ?")
+            params.append(args[col])
+    if args.get('since'):
+        where.append(f"{table}.time >= ?")
+        params.append(history_time(args['since']))
+    if args.get('until'):
+        where.append(f"{table}.time < ?")
+        params.append(history_time(args['until'], end=True))
+    return where, params
+
+def history_cursor(values=None, token=None):
+    """Opaque keyset cursor: encode a list of values, or decode a token back into one."""
+    if token is None: return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+    return json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+
+def fts_query(q):
+    """FTS5 query matching every word of `q`, each as a prefix."""
+    words = re.findall(r"\w+", q)
+    return " ".join('"%s"*' % w for w in words)
+
+@app.route('/history/search')
+def history_search():
+    """Plays matching q (artist, title, station, album, program; words are prefixes).
+
+    Filters: station, zone, since/until (YYYY-MM-DD or unix time).  sort=rank
+    (best match first, default) or time (newest first).  Returns results and a
+    `next` cursor to pass back as cursor= for the following page.  Ranked pages
+    all come from the plays recorded before the first page, so new plays
+    can't push rows in between pages; they still shift every rank a little
+    (bm25 weighs words by the whole table), which can reorder near-ties.
+    """
+    match = fts_query(request.args.get('q', ''))
+    if not match: return jsonify({'error': 'q is required'}), 400
+    sort = request.args.get('sort', 'rank')
+    if sort not in ('rank', 'time'): return jsonify({'error': 'sort must be rank or time'}), 400
+    try:
+        where, params = history_filters(request.args, "t")
+        limit = max(1, min(int(request.args.get('limit', 50)), 500))
+        after = history_cursor(token=request.args['cursor']) if request.args.get('cursor') else None
+        # A ranked cursor is (offset, last rowid when paging began) rather than
+        # the rank itself, which moves for every row whenever a play is added
+        offset, snapshot = (int(after[0]), int(after[1])) if sort == 'rank' and after else (0, None)
+    except (ValueError, TypeError, IndexError) as E: return jsonify({'error': f"bad argument: {E}"}), 400
+    where.insert(0, "tracks_fts MATCH ?")
+    params.insert(0, match)
+    if sort == 'rank':
+        order = "tracks_fts.rank, t.rowid"
+        where.append("t.rowid <= ?")
+    else:
+        order = "t.time DESC, t.rowid DESC"
+        if after:
+            where.append("(t.time < ? OR (t.time = ? AND t.rowid < ?))")
+            params += [after[0], after[0], after[1]]
+    query = (f"SELECT t.rowid, t.*, tracks_fts.rank AS rank FROM tracks_fts JOIN tracks t ON t.rowid = tracks_fts.rowid "
+             f"WHERE {' AND '.join(where)} ORDER BY {order} LIMIT ? OFFSET ?")
+    db = history_open()
+    try:
+        if sort == 'rank':
+            if snapshot is None: snapshot = db.execute("SELECT max(rowid) FROM tracks").fetchone()[0] or 0
+            params.append(snapshot)
+        rows = db.execute(query, params + [limit, offset])
+        cols = [c[0] for c in rows.description]
+        results = [dict(zip(cols, r)) for r in rows.fetchall()]
+    except sqlite3.OperationalError as E: return jsonify({'error': str(E)}), 503
+    finally: db.close()
+    nxt = None
+    if len(results) == limit:
+        last = results[-1]
+        nxt = history_cursor([offset + limit, snapshot] if sort == 'rank' else [last['time'], last['rowid']])
+    for r in results: r.pop('rowid')
+    return jsonify({'results': results, 'next': nxt})
+
+@app.route('/history/export')
+def history_export():
+    """Every play matching the filters, oldest first, streamed as NDJSON (default) or CSV.
+
+    Filters: station, zone, since/until (YYYY-MM-DD or unix time).  after=<time>
+    resumes after the last row received.  gzip-encoded if the client accepts it.
+    """
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in ('ndjson', 'csv'): return jsonify({'error': 'format must be ndjson or csv'}), 400
+    try:
+        where, params = history_filters(request.args)
+        after = float(request.args['after']) if request.args.get('after') else None
+    except ValueError as E: return jsonify({'error': f"bad argument: {E}"}), 400
+    gz = request.accept_encodings['gzip'] > 0
+
+    def export():
+        # Read-only connection, one short query per batch keyed on time: memory
+        # stays flat and no read transaction is held open for the whole export,
+        # so the history writer never waits and the WAL can still checkpoint
+        conn = sqlite3.connect(f"file:{quote(os.path.abspath(HISTORY_DB))}?mode=ro", uri=True)
+        try:
+            cols = [c[1] for c in conn.execute("PRAGMA table_info(tracks)")]
+            select = ", ".join('"%s"' % c.replace('"', '""') for c in cols)
+            deflate = zlib.compressobj(6, zlib.DEFLATED, 31) if gz else None
+            out = io.StringIO()
+            writer = csv.writer(out)
+            if fmt == 'csv': writer.writerow(cols)
+            last = after
+            while True:
+                cond = where + (["time > ?"] if last is not None else [])
+                batch = conn.execute(f"SELECT {select} FROM tracks {'WHERE ' + ' AND '.join(cond) if cond else ''} ORDER BY time LIMIT 1000",
+                                     params + ([last] if last is not None else [])).fetchall()
+                for row in batch:
+                    if fmt == 'csv': writer.writerow(row)
+                    else: out.write(json.dumps(dict(zip(cols, row))) + "\n")
+                chunk = out.getvalue().encode()
+                out.seek(0)
+                out.truncate()
+                if chunk: yield deflate.compress(chunk) if gz else chunk
+                if len(batch) < 1000: break
+                last = batch[-1][cols.index('time')]
+            if gz: yield deflate.flush()
+        finally: conn.close()
+
+    headers = {'Content-Disposition': f"attachment; filename=tracks.{fmt}", 'Vary': 'Accept-Encoding'}
+    if gz: headers['Content-Encoding'] = 'gzip'
+    return Response(export(), mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson', headers=headers)
+
+@socketio.on("join_zone")
+def join_zone(data):
+    """Move the client into the room for its selected zone and send what we know."""
+    zone = data.get('zone')
+    for room in rooms():
+        if room != request.sid: leave_room(room)
+    if zone not in zs: return
+    join_room(zone)
+    emit('snapshot', broadcast.snapshot(zone))
+    metrics.inc('not_tunein_socketio_emits_total', event='snapshot')
 
 @socketio.on("system_query")
-def system_response(data): socketio.emit("system_update",{'system':BACKEND,'station':current_station})
+def system_response(data):
+    emit("system_update",{'system':BACKEND,'station':current_station})
+    metrics.inc('not_tunein_socketio_emits_total', event='system_update')
 
 current_station = None
 current_station_idx = None  # Track station index for NeoTrellis button
 current_mqtt_node = None    # Track the MQTT node for light control
 
+# Backend actions, shared by the HTTP routes, MQTT and the zone workers
+def via_relay(station_url):
+    # YouTube stream URLs expire too quickly to hand to a speaker, so on
+    # Sonos those always go through the relay; with RELAY (or TIMESHIFT,
+    # which needs it) everything does
+    return RELAY or TIMESHIFT or (BACKEND == "sonos" and is_youtube_url(station_url))
+
+def prepare_play(station, station_url):
+    """The slow part of starting a station, which needs no speaker: resolve a
+    YouTube URL, and wait for the relay's upstream if it'll be played from
+    there; if the relay can't reach it, it's played directly instead.
+    Returns the URL to hand backend_play; raises ValueError if the station
+    can't be played."""
+    play_url = station_url
+    if is_youtube_url(station_url):
+        print(f"Detected YouTube URL for {station}, extracting stream URL...")
+        play_url = get_youtube_stream_url(station_url)
+        if not play_url: raise ValueError('Could not extract YouTube stream URL')
+    if via_relay(station_url) and not relay_for(station, station_url).ready.wait(RELAY_TIMEOUT):
+        # Sonos can't play a YouTube stream itself
+        if BACKEND == "sonos" and is_youtube_url(station_url): raise ValueError('Station not reachable')
+        print(f"Relay can't reach {station}, playing it directly")
+    return play_url
+
+def backend_play(zone, station, station_url, play_url=None):
+    """Start a station on a zone; returns the result dict sent to clients.
+
+    play_url is what prepare_play returned; without it that happens here.
+    """
+    drop_timeshift(zone)
+    if play_url is None:
+        try: play_url = prepare_play(station, station_url)
+        except ValueError as E: return {'result':'error','message':str(E)}
+
+    if via_relay(station_url) and relay_ready(station):
+        play_relay(zone, station)
+
+    elif BACKEND == "sonos":
+        with metrics.timed("sonos.play_uri"): SoCo(zs[zone]).play_uri("x-rincon-mp3radio://"+station_url,title=station)
+
+    elif BACKEND == "mpc":
+        # Clear, add and play in one round trip
+        start_mpc(play_url)
+
+    out = {'result':'success','station':station,'zone':zone} if BACKEND == "sonos" else {'result':'success','station':station}
+    broadcast.update(zone, station=station)
+    tuned[zone] = station_url
+    station_metadata(station)   # starts its metadata reader, if it has one
+    if BACKEND == "sonos":
+        # An event during play_uri was read against the previous station
+        try: sonos_push_track(zone)
+        except Exception as E: print(f"Sonos refresh error on {zone}: {E}")
+    print(f"Playing station: {station}")
+    if pync: notify(f"Playing {station}",title='NT')
+    return out
+
+def play_relay(zone, station, at=None):
+    """Point a zone at the station's relay, from unix time `at` in the time-shift buffer or live."""
+    if BACKEND == "sonos":
+        uri = relay_url(zs[zone], station, at)
+        if not is_youtube_url(catalog.get(station) or ""): uri = "x-rincon-mp3radio://" + uri.split("://", 1)[1]
+        with metrics.timed("sonos.play_uri"): SoCo(zs[zone]).play_uri(uri,title=station)
+    if BACKEND == "mpc":
+        start_mpc(relay_url(MPD_HOST, station, at))
+
+# Time-shifted zones: paused ones keep their station's relay recording
+paused = {}   # zone -> (station, unix time of the audio it stopped at)
+behind = {}   # zone -> seconds behind live
+
+def drop_timeshift(zone):
+    entry = paused.pop(zone, None)
+    if entry and entry[0] in relays: relays[entry[0]].release(zone)
+    behind.pop(zone, None)
+    if TIMESHIFT: broadcast.update(zone, paused=False, behind=0)
+
+def backend_pause(zone):
+    """Pause a zone; its station keeps recording to the time-shift buffer
+    (without TIMESHIFT, or with nothing buffered, this is a stop)."""
+    if zone in paused: return {'result':'success','action':'paused','zone':zone}
+    station = broadcast.get(zone, 'station')
+    relay = relays.get(station)
+    if not TIMESHIFT or not relay_ready(station) or not relay.running:
+        backend_stop(zone)
+        return {'result':'success','action':'stopped','zone':zone}
+    with relay.cond: relay.holds.add(zone)
+    paused[zone] = (station, time.time() - behind.get(zone, 0))
+    if BACKEND == "sonos":
+        with metrics.timed("sonos.stop"): SoCo(zs[zone]).stop()
+    if BACKEND == "mpc": stop_mpc()
+    broadcast.update(zone, paused=True)
+    print(f"Paused {station} on {zone}")
+    return {'result':'success','action':'paused','zone':zone}
+
+def backend_seek(zone, back=None):
+    """Resume a paused zone, moving it `back` seconds further back in the
+    buffer first if given (negative goes forward); back=0 goes live."""
+    if zone in paused: station, at = paused[zone]
+    else: station, at = broadcast.get(zone, 'station'), time.time() - behind.get(zone, 0)
+    relay = relays.get(station)
+    if not TIMESHIFT or not relay_ready(station) or not relay.running:
+        return {'result':'error','message':'nothing buffered for this zone'}
+    now = time.time()
+    at = min(now, max(at - (back or 0), now - TIMESHIFT * 60))
+    live = back == 0 or now - at < 1
+    play_relay(zone, station, None if live else at)
+    entry = paused.pop(zone, None)
+    if entry: relay.release(zone)
+    behind[zone] = 0 if live else now - at
+    broadcast.update(zone, paused=False, behind=int(behind[zone]))
+    print(f"Playing {station} on {zone} " + ("live" if live else f"{int(behind[zone])}s behind"))
+    return {'result':'success','station':station,'zone':zone,'behind':int(behind[zone])}
+
+def backend_stop(zone):
+    global state
+    tuned.pop(zone, None)
+    drop_timeshift(zone)
+    if BACKEND == "sonos":
+        with metrics.timed("sonos.stop"): SoCo(zs[zone]).stop()
+    if BACKEND == "mpc":
+        state = "stopped"
+        clear_mpc()
+        stop_mpc()
+        # Cancel sleep timer if exists
+        try:
+            tt.cancel()
+            print("Sleep timer cancelled")
+        except: pass
+    print("Stopped playback")
+    if pync: notify("Stopped",title='NT')
+
+def backend_volume(zone, volume=None, delta=0):
+    """Set a zone's volume to `volume` (or its current volume) plus `delta`; returns the new volume."""
+    if BACKEND == "sonos":
+        speaker = SoCo(zs[zone])
+        with metrics.timed("sonos.volume"):
+            new_vol = max(0, min(100, int(speaker.volume if volume is None else volume) + delta))
+            speaker.volume = new_vol
+    if BACKEND == "mpc":
+        new_vol = max(0, min(100, int(get_vol_mpc() if volume is None else volume) + delta))
+        vol_mpc(new_vol)
+    broadcast.update(zone, volume=new_vol)
+    return new_vol
+
+def backend_sleep(zone, seconds):
+    global tt
+    if BACKEND == "sonos":
+        with metrics.timed("sonos.set_sleep_timer"): SoCo(zs[zone]).set_sleep_timer(seconds)
+    if BACKEND == "mpc":
+        tt = setTimeout(seconds)
+    print(f"Sleep timer set for {seconds // 60} minutes on {zone}")
+
+def backend_transport(zone):
+    """(playing, state) for a zone: playing is True, False if it failed, or None while starting."""
+    if BACKEND == "sonos":
+        with metrics.timed("sonos.transport_info"):
+            state = SoCo(zs[zone]).get_current_transport_info()['current_transport_state']
+        return (True if state == "PLAYING" else None), state
+    if BACKEND == "mpc":
+        status = mpd.status()
+        if status.get('error'): return False, status['error']
+        return (True if status.get('state') == "play" else None), status.get('state')
+
+# Zone jobs: requests and MQTT only queue work for a zone's worker and get a
+# job back; its progress goes to the zone's room as events, and stays
+# readable at /zone_jobs/<id> for PLAY_JOBS_KEEP seconds after it finishes.
+#
+# Starting a station is a PlayJob: queued -> resolving -> buffering ->
+# playing (or failed, or cancelled), as 'play_job' events.  Resolving and
+# waiting for the zone to start playing happen on play_pool, so only the
+# backend call itself runs on the worker.  A newer play, stop, pause or
+# seek on the zone cancels the job in flight
+class PlayCancelled(Exception): None
+
+zone_jobs = {}   # job id -> ZoneJob
+zone_jobs_lock = threading.Lock()
+
+class ZoneJob:
+    """A command run on the zone's worker (stop, pause, seek, ungroup): queued
+    -> done or failed, as 'zone_job' events carrying the backend's result."""
+    event = 'zone_job'
+
+    def __init__(self, zone, fn=None, *args):
+        self.id = os.urandom(6).hex()
+        self.zone = zone
+        self.fn = fn
+        self.args = args
+        self.action = fn.__name__.replace("backend_", "") if fn else None
+        self.state = 'queued'
+        self.error = None
+        self.result = None
+        self.created = self.updated = time.time()
+        self.finished = False
+        with zone_jobs_lock:
+            for old in [j for j in zone_jobs.values() if j.finished and self.created - j.updated > PLAY_JOBS_KEEP]:
+                zone_jobs.pop(old.id, None)
+            zone_jobs[self.id] = self
+
+    def label(self): return self.action
+
+    def info(self):
+        return {'job': self.id, 'zone': self.zone, 'action': self.action, 'state': self.state, 'error': self.error,
+                'result': self.result, 'created': self.created, 'updated': self.updated}
+
+    def set(self, state, error=None):
+        self.state, self.error, self.updated = state, error, time.time()
+        socketio.emit(self.event, self.info(), to=self.zone)
+        metrics.inc('not_tunein_socketio_emits_total', event=self.event)
+
+    def finish(self, state, error=None):
+        with zone_jobs_lock:
+            if self.finished: return
+            self.finished = True
+        if state == 'failed': print(f"{self.label()} on {self.zone} failed: {error}")
+        self.set(state, error)
+
+    def run(self):
+        """On the zone's worker."""
+        try: self.result = self.fn(self.zone, *self.args)
+        except Exception as E: return self.finish('failed', str(E))
+        if isinstance(self.result, dict) and self.result.get('result') == 'error': self.finish('failed', self.result.get('message'))
+        else: self.finish('done')
+
+class PlayJob(ZoneJob):
+    event = 'play_job'
+
+    def __init__(self, zone, station, url, group=None):
+        self.station = station
+        self.url = url
+        self.group = group or []   # zones to join to this one first (Sonos)
+        self.play_url = None
+        self.cancelled = threading.Event()
+        self.reason = None
+        super().__init__(zone)
+        self.action = 'play'
+
+    def label(self): return f"Playing {self.station}"
+
+    def info(self): return dict(super().info(), station=self.station)
+
+    def step(self, state):
+        if self.cancelled.is_set(): raise PlayCancelled()
+        self.set(state)
+
+    def cancel(self, reason):
+        self.reason = reason
+        self.cancelled.set()
+        if self.state in ('queued', 'resolving'): self.finish('cancelled', reason)
+
+    def prepare(self):
+        """On play_pool: resolve the station and join the group, then queue the backend call."""
+        try:
+            self.step('resolving')
+            self.play_url = prepare_play(self.station, self.url)
+            if self.group: fanout(self.group, backend_join, self.zone)
+            if self.cancelled.is_set(): raise PlayCancelled()
+            commands(self.zone).submit(play=self)
+        except PlayCancelled: self.finish('cancelled', self.reason)
+        except Exception as E: self.finish('failed', str(E))
+
+    def start(self):
+        """On the zone's worker: tell the backend, then watch it start on play_pool."""
+        try:
+            self.step('buffering')
+            out = backend_play(self.zone, self.station, self.url, self.play_url)
+            if out.get('result') != 'success': return self.finish('failed', out.get('message'))
+            play_pool.submit(self.confirm)
+        except PlayCancelled: self.finish('cancelled', self.reason)
+        except Exception as E: self.finish('failed', str(E))
+
+    def confirm(self):
+        deadline = time.time() + PLAY_TIMEOUT
+        state = None
+        while not self.cancelled.is_set():
+            try: playing, state = backend_transport(self.zone)
+            except Exception as E: playing, state = None, str(E)
+            if playing: return self.finish('playing')
+            if playing is False: return self.finish('failed', state)
+            if time.time() > deadline: return self.finish('failed', f"didn't start playing ({state})")
+            time.sleep(0.25)
+        self.finish('cancelled', self.reason)
+
+play_pool = ThreadPoolExecutor(max_workers=FANOUT_WORKERS)
+
+class ZoneCommands:
+    """Runs one zone's commands in order on its own worker thread.
+
+    Commands that arrive while the worker is busy with the speaker are merged:
+    station changes collapse to the last one asked for and volume steps are
+    summed, so a held remote button costs one backend call, not one per press.
+    Station starts are PlayJobs; the zone's newest one cancels the one before.
+    Other commands are queued as ZoneJobs and run in order, before a station
+    change that arrived with them.
+    """
+    def __init__(self, zone):
+        self.zone = zone
+        self.cond = threading.Condition()
+        self.busy = threading.Lock()   # held while talking to the backend
+        self.play = None               # a prepared PlayJob
+        self.job = None                # the newest PlayJob, until it's done
+        self.calls = []                # queued ZoneJobs
+        self.volume = None             # absolute volume, applied before delta
+        self.delta = 0
+        self.sleep = None
+        self.last_volume = None
+        self.since = None              # when the oldest pending command arrived
+        threading.Thread(target=self.worker, daemon=True).start()
+
+    def start(self, station, url, group=None):
+        """Start a station as a PlayJob and return it without waiting."""
+        job = PlayJob(self.zone, station, url, group)
+        self.supersede(job)
+        play_pool.submit(job.prepare)
+        return job
+
+    def supersede(self, job=None, reason="superseded"):
+        """Cancel the play in flight (unless it's `job`), making `job` the newest."""
+        with self.cond:
+            old, self.job = self.job, job
+            if isinstance(self.play, PlayJob) and self.play is not job: self.play = None
+        if old and old is not job: old.cancel(reason)
+
+    def queue(self, fn, *args):
+        """Queue fn(zone, *args) for the worker and return its ZoneJob without waiting.
+
+        Stopping, pausing and seeking supersede a station change in flight.
+        """
+        reason = {backend_stop: "stopped", backend_pause: "paused", backend_seek: "seeked"}.get(fn)
+        if reason: self.supersede(reason=reason)
+        job = ZoneJob(self.zone, fn, *args)
+        with self.cond:
+            self.calls.append(job)
+            if self.since is None: self.since = time.perf_counter()
+            self.cond.notify()
+        return job
+
+    def submit(self, play=None, volume=None, delta=0, sleep=None):
+        with self.cond:
+            if isinstance(play, PlayJob) and play is not self.job: return   # superseded while resolving
+            if play is not None: self.play = play
+            if volume is not None: self.volume, self.delta = volume, 0
+            self.delta += delta
+            if sleep is not None: self.sleep = sleep
+            if self.since is None: self.since = time.perf_counter()
+            self.cond.notify()
+
+    def expected_volume(self):
+        """Best guess at where the volume will end up once pending steps run."""
+        with self.cond:
+            base = self.volume if self.volume is not None else self.last_volume
+            return None if base is None else max(0, min(100, int(base) + self.delta))
+
+    def run(self, fn, *args):
+        """Run a command now in the caller's thread, in order with the queued ones.
+
+        Waits for the backend, so only for threads that can afford to, like
+        a PlayJob joining its group on play_pool.
+        """
+        with self.cond:
+            if self.volume is None and not self.delta and self.sleep is None and self.play is None and not self.calls: self.since = None
+        with self.busy: return fn(self.zone, *args)
+
+    def worker(self):
+        while True:
+            with self.cond:
+                while not self.calls and self.play is None and self.volume is None and not self.delta and self.sleep is None:
+                    self.cond.wait()
+                calls, play, volume, delta, sleep = self.calls, self.play, self.volume, self.delta, self.sleep
+                self.calls, self.play, self.volume, self.delta, self.sleep = [], None, None, 0, None
+                since, self.since = self.since, None
+            with self.busy:
+                if since: metrics.observe('not_tunein_command_wait_seconds', time.perf_counter() - since)
+                for job in calls: job.run()
+                try:
+                    if play: play.start()
+                    if volume is not None or delta:
+                        self.last_volume = backend_volume(self.zone, volume, delta)
+                    if sleep is not None: backend_sleep(self.zone, sleep)
+                except Exception as E:
+                    print(f"Command for {self.zone} failed: {E}")
+
+zone_commands = {}
+_commands_lock = threading.Lock()
+
+def commands(zone):
+    with _commands_lock:
+        if zone not in zone_commands: zone_commands[zone] = ZoneCommands(zone)
+        return zone_commands[zone]
+
+def request_zone(data):
+    if BACKEND == "mpc": return "mpc"
+    return data['zone']
+
+def request_zones(data):
+    """Zones a request targets: `zones` (a list, comma-separated names or "all"), else `zone`."""
+    if BACKEND == "mpc": return ["mpc"]
+    zones = data.get('zones')
+    if zones is None and hasattr(data, 'getlist'): zones = data.getlist('zones[]') or None
+    if zones is None: return [data['zone']]
+    if isinstance(zones, str):
+        zones = list(zs) if zones == "all" else [z.strip() for z in zones.split(",") if z.strip()]
+    for zone in zones:
+        if zone not in zs: raise KeyError(zone)
+    return zones
+
+def fanout(zones, fn, *args):
+    """Run fn(zone, *args) for every zone at once, each in order with that zone's
+    queued commands.  Returns {zone: result}; a failing zone doesn't stop the others."""
+    if len(zones) == 1: return {zones[0]: commands(zones[0]).run(fn, *args)}
+    futures = {zone: fanout_pool.submit(commands(zone).run, fn, *args) for zone in zones}
+    out = {}
+    for zone, future in futures.items():
+        try: out[zone] = future.result()
+        except Exception as E: out[zone] = {'result':'error','message':str(E)}
+    return out
+
+fanout_pool = ThreadPoolExecutor(max_workers=FANOUT_WORKERS)
+
+def backend_join(zone, coordinator):
+    with metrics.timed("sonos.join"): SoCo(zs[zone]).join(SoCo(zs[coordinator]))
+
+def backend_unjoin(zone):
+    with metrics.timed("sonos.unjoin"): SoCo(zs[zone]).unjoin()
+
 @app.route('/play_station',methods = ['POST'])
 def play_station():
     global current_station, state, current_station_idx
@@ -469,88 +2632,100 @@ def play_station():
     # Convert station index to station name if needed
     if isinstance(station, int) or (isinstance(station, str) and station.isdigit()):
         current_station_idx = int(station)
-        station = skeys[current_station_idx]
+        station, station_url = catalog.at(current_station_idx)
     else:
         # Look up index by name
-        try:
-            current_station_idx = skeys.index(station)
-        except (ValueError, AttributeError):
-            current_station_idx = None
+        current_station_idx = catalog.index(station)
+        station_url = catalog.stations[station]
 
     current_station = station
-
-    # Get the station URL
-    station_url = stations[station]
-
-    if BACKEND == "sonos":
-        # Check if it's a YouTube URL - not supported on Sonos (URLs expire too quickly)
-        if is_youtube_url(station_url):
-            out = {'result':'error','message':'YouTube Music is not supported on Sonos (stream URLs expire too quickly for reliable playback)'}
-            return jsonify(out)
-        zone = data['zone']
-        SoCo(zs[zone]).play_uri("x-rincon-mp3radio://"+station_url,title=station)
-        out = {'result':'success','station':station,'zone':zone}
-
-    if BACKEND == "mpc":
-        clear_mpc()
-
-        # Check if it's a YouTube URL and set up FIFO streaming
-        if is_youtube_url(station_url):
-            print(f"Detected YouTube URL for {station}, extracting stream URL...")
-            stream_url = get_youtube_stream_url(station_url)
-            if stream_url:
-                station_url = stream_url
-            else:
-                out = {'result':'error','message':'Could not extract YouTube stream URL'}
-                return jsonify(out)
-
-        # Add to MPD and play
-        add_mpc(station_url)
-
-        current_station = station
-        if osa and current_station.find("Apple Music") ==0:
-            play_osa()
-        else:
-            play_mpc()
-        out = {'result':'success','station':station}
-
-    socketio.emit("play",out)
-    if pync: notify(f"Playing {station}",title='NT')
-    return jsonify(out)
+    zones = request_zones(data)
+    # Starting a station can take seconds (resolving YouTube, waiting for the
+    # upstream, the speaker buffering), so answer now with the play jobs and
+    # let their 'play_job' events, or /zone_jobs/<id>, tell how it went
+    if BACKEND == "sonos" and len(zones) > 1 and str(data.get('group', '')).lower() in ("1", "true", "yes"):
+        # One coordinator pulls the stream and the rest of the group syncs to it
+        jobs = {zones[0]: commands(zones[0]).start(station, station_url, group=zones[1:])}
+    else:
+        jobs = {zone: commands(zone).start(station, station_url) for zone in zones}
+    out = {'result':'accepted','station':station,'jobs':{zone: job.id for zone, job in jobs.items()}}
+    if len(zones) == 1: out.update(zone=zones[0], job=jobs[zones[0]].id)
+    elif len(jobs) == 1: out.update(zones=zones, coordinator=zones[0], job=jobs[zones[0]].id)
+    return jsonify(out), 202
+
+@app.route('/zone_jobs/<job_id>',methods = ['GET'])
+@app.route('/play_jobs/<job_id>',methods = ['GET'])
+def zone_job(job_id):
+    job = zone_jobs.get(job_id)
+    if not job: return jsonify({'result':'error','message':'Unknown job'}), 404
+    return jsonify(job.info())
+
+def queue_zones(zones, fn, *args, **out):
+    """Queue fn on each zone's worker and answer 202 with the jobs; their
+    'zone_job' events, or /zone_jobs/<id>, report the backend's result."""
+    jobs = {zone: commands(zone).queue(fn, *args) for zone in zones}
+    out = dict(out, result='accepted', jobs={zone: job.id for zone, job in jobs.items()})
+    if len(zones) == 1: out.update(zone=zones[0], job=jobs[zones[0]].id)
+    return jsonify(out), 202
 
 state = "stopped"
 
 @app.route('/stop',methods = ['POST', 'GET'])
 def stop():
-    global state
     try: data = request.json
     except: data = request.form
-    if BACKEND == "sonos": 
-        zone = data['zone']
-        SoCo(zs[zone]).stop()
-        out = {'result':'success','action':f"stopped {zone}"}    
-    if BACKEND == "mpc":
-        zone = "mpc"
-        state = "stopped"
+    zones = request_zones(data)
+    if BACKEND == "sonos": action = f"stopping {', '.join(zones)}"
+    if BACKEND == "mpc": action = "stopping"
+    return queue_zones(zones, backend_stop, action=action)
+
+@app.route('/pause',methods = ['POST', 'GET'])
+def pause():
+    """Stop the zone's speaker but keep its station in the time-shift buffer."""
+    try: data = request.json
+    except: data = request.form
+    return queue_zones(request_zones(data or request.args), backend_pause)
 
-        clear_mpc()
-        stop_mpc()
-        out = {'result':'success','action':f"stopped"}  
-        if pync: notify("Stopped",title='NT') 
-    return jsonify(out)
+@app.route('/resume',methods = ['POST', 'GET'])
+def resume():
+    try: data = request.json
+    except: data = request.form
+    return queue_zones(request_zones(data or request.args), backend_seek)
+
+@app.route('/rewind',methods = ['POST', 'GET'])
+def rewind():
+    """Go `seconds` (default 300) further back in the time-shift buffer; negative goes forward."""
+    try: data = request.json
+    except: data = request.form
+    data = data or request.args
+    try:
+        seconds = float(data.get('seconds', 300))
+        if seconds != seconds or abs(seconds) == float('inf'): raise ValueError(f"seconds must be a number, not {seconds}")
+    except (ValueError, TypeError) as E: return jsonify({'error': f"bad argument: {E}"}), 400
+    return queue_zones(request_zones(data), backend_seek, seconds)
+
+@app.route('/live',methods = ['POST', 'GET'])
+def live():
+    try: data = request.json
+    except: data = request.form
+    return queue_zones(request_zones(data or request.args), backend_seek, 0)
+
+@app.route('/ungroup',methods = ['POST'])
+def ungroup():
+    try: data = request.json
+    except: data = request.form
+    zones = request_zones(data)
+    if BACKEND == "sonos": return queue_zones(zones, backend_unjoin, action=f"ungrouping {', '.join(zones)}")
+    return jsonify({'result':'success','action':f"ungrouped {', '.join(zones)}"})
 
 @app.route('/sleep',methods = ['POST'])
 def sleep():
     try: data = request.json
     except: data = request.form
     sleep = int(data['sleep'])*60
-    if BACKEND == "sonos": 
-        zone = data['zone']
-        SoCo(zs[zone]).set_sleep_timer(sleep)
-    if BACKEND == "mpc": 
-        zone = "mpc"
-        tt = setTimeout(sleep)
-    out = {'result':'success','action':f"{zone} sleeping in {data['sleep']} minutes"}    
+    zones = request_zones(data)
+    for zone in zones: commands(zone).submit(sleep=sleep)
+    out = {'result':'success','action':f"{', '.join(zones)} sleeping in {data['sleep']} minutes"}    
     return jsonify(out)
 
 
@@ -571,205 +2746,150 @@ def sleepcancel():
 def set_volume():
     try: data = request.json
     except: data = request.form
-    volume = data['volume']
-    if BACKEND == "sonos": 
-        volume = int(data['volume'])
-        zone = data['zone']
-        SoCo(zs[zone]).volume = volume
-        socketio.emit("volume",json.dumps({'volume':volume}))
-        out = {'result':'success','action':f"{zone} volume set to {volume}"}    
-    if BACKEND == "mpc": 
-        print(volume)
-        vol_mpc(volume)
-        vol = get_vol_mpc()
-        socketio.emit("volume",{'volume':vol})
-        out = {'result':'success','action':f"volume set to {volume}"}    
-
+    volume = int(data['volume'])
+    zones = request_zones(data)
+    for zone in zones: commands(zone).submit(volume=volume)
+    if BACKEND == "sonos": out = {'result':'success','action':f"{', '.join(zones)} volume set to {volume}"}    
+    if BACKEND == "mpc": out = {'result':'success','action':f"volume set to {volume}"}    
     return jsonify(out)
 
 @app.route('/get_volume',methods = ['POST'])
 def get_volume():
     try: data = request.json
     except: data = request.form
-    if BACKEND == "sonos": 
-        zone = data['zone']
-        out = {'result':'success','action':f"got {zone} volume","volume":SoCo(zs[zone]).volume}    
-    if BACKEND == "mpc":
-        out = {'result':'success','action':f"got volume","volume":get_vol_mpc()}    
-
-    return jsonify(out)
+    zone = request_zone(data)
+    # Kept current by the zone's events; until the first one arrives the
+    # speaker is asked on the zone's worker and the answer is pushed as a delta
+    volume = broadcast.get(zone, 'volume')
+    action = f"got {zone} volume" if BACKEND == "sonos" else "got volume"
+    if volume is None:
+        job = commands(zone).queue(backend_get_volume)
+        return jsonify({'result':'accepted','action':action,'volume':None,'zone':zone,'job':job.id}), 202
+    return jsonify({'result':'success','action':action,'volume':volume})
+
+def backend_get_volume(zone):
+    if BACKEND == "sonos":
+        with metrics.timed("sonos.volume"): volume = SoCo(zs[zone]).volume
+    if BACKEND == "mpc": volume = int(get_vol_mpc())
+    broadcast.update(zone, volume=volume)
+    return {'result':'success','volume':volume}
+
+def step_volume(delta):
+    zones = request_zones(request.args)
+    for zone in zones: commands(zone).submit(delta=delta)
+    zone = ', '.join(zones)
+    new_vol = commands(zones[0]).expected_volume() if len(zones) == 1 else None
+    direction = "up" if delta > 0 else "down"
+    if BACKEND == "sonos": action = f"{zone} volume {direction}"
+    if BACKEND == "mpc": action = f"volume {direction}"
+    if new_vol is not None: action += f" to {new_vol}"
+    return jsonify({'result':'success','action':action,"volume":new_vol})
 
 @app.route('/volume_up',methods = ['GET'])
-def volume_up():
-    data = request.args
-    if BACKEND == "sonos":
-        zone = data['zone']
-        current_vol = SoCo(zs[zone]).volume
-        new_vol = current_vol + 5
-        SoCo(zs[zone]).volume = new_vol
-        socketio.emit("volume",json.dumps({'volume':new_vol}))
-        out = {'result':'success','action':f"{zone} volume up to {new_vol}","volume":new_vol}
-    if BACKEND == "mpc":
-        current_vol = int(get_vol_mpc())
-        new_vol = current_vol + 5
-        vol_mpc(new_vol)
-        socketio.emit("volume",{'volume':new_vol})
-        out = {'result':'success','action':f"volume up to {new_vol}","volume":new_vol}
-    return jsonify(out)
+def volume_up(): return step_volume(5)
 
 @app.route('/volume_down',methods = ['GET'])
-def volume_down():
-    data = request.args
-    if BACKEND == "sonos":
-        zone = data['zone']
-        current_vol = SoCo(zs[zone]).volume
-        new_vol = current_vol - 5
-        SoCo(zs[zone]).volume = new_vol
-        socketio.emit("volume",json.dumps({'volume':new_vol}))
-        out = {'result':'success','action':f"{zone} volume down to {new_vol}","volume":new_vol}
-    if BACKEND == "mpc":
-        current_vol = int(get_vol_mpc())
-        new_vol = current_vol - 5
-        vol_mpc(new_vol)
-        socketio.emit("volume",{'volume':new_vol})
-        out = {'result':'success','action':f"volume down to {new_vol}","volume":new_vol}
-    return jsonify(out)
+def volume_down(): return step_volume(-5)
 
-@app.route('/station_up',methods = ['GET'])
-def station_up():
+def step_station(delta):
     global current_station, state, current_station_idx
-    data = request.args
+    zone = request_zone(request.args)
 
-    # Find current station index
-    try:
-        current_idx = skeys.index(current_station)
-    except:
-        current_idx = -1
-
-    # Move to next station (wrap around)
-    next_idx = (current_idx + 1) % len(skeys)
-    station = skeys[next_idx]
+    # Move to the next/previous station (wrap around); only the last of a
+    # burst of steps actually gets played
+    idx, station, station_url = catalog.step(current_station, delta, skip=station_dead)
     current_station = station
-    current_station_idx = next_idx
+    current_station_idx = idx
     state = current_station
 
-    # Get station URL
-    station_url = stations[station]
-
-    if BACKEND == "sonos":
-        # YouTube URLs not supported on Sonos
-        if is_youtube_url(station_url):
-            out = {'result':'error','message':'YouTube Music is not supported on Sonos'}
-            return jsonify(out)
-        zone = data['zone']
-        SoCo(zs[zone]).play_uri("x-rincon-mp3radio://"+station_url,title=station)
-        out = {'result':'success','station':station,'zone':zone}
+    # Queued like /play_station; its 'play_job' events tell how it went
+    job = commands(zone).start(station, station_url)
+    return jsonify({'result':'accepted','station':station,'jobs':{zone: job.id},'zone':zone,'job':job.id}), 202
 
-    if BACKEND == "mpc":
-        clear_mpc()
-        # Extract stream URL for YouTube URLs
-        if is_youtube_url(station_url):
-            print(f"Station Up: extracting stream URL for {station}...")
-            stream_url = get_youtube_stream_url(station_url)
-            if stream_url:
-                station_url = stream_url
-            else:
-                out = {'result':'error','message':'Could not extract YouTube stream URL'}
-                return jsonify(out)
-        add_mpc(station_url)
-        if osa and current_station.find("Apple Music") == 0:
-            play_osa()
-        else:
-            play_mpc()
-        out = {'result':'success','station':station}
-
-    socketio.emit("play",out)
-    if pync: notify(f"Playing {station}",title='NT')
-    return jsonify(out)
+@app.route('/station_up',methods = ['GET'])
+def station_up(): return step_station(1)
 
 @app.route('/station_down',methods = ['GET'])
-def station_down():
-    global current_station, state, current_station_idx
-    data = request.args
+def station_down(): return step_station(-1)
 
-    # Find current station index
-    try:
-        current_idx = skeys.index(current_station)
-    except:
-        current_idx = 0
 
-    # Move to previous station (wrap around)
-    prev_idx = (current_idx - 1) % len(skeys)
-    station = skeys[prev_idx]
-    current_station = station
-    current_station_idx = prev_idx
-    state = current_station
+def push_status():
+    status = get_status_mpc()
+    if state != "stopped" and 'track' in broadcast.update('mpc', track=status): 
+        if pync and (status['title'] is not status['artist']): notify(f"Playing {status['title']} by {status['artist']} on {status['station']}",title='NT',open=BURL)
 
-    # Get station URL
-    station_url = stations[station]
+def status_watcher():
+    """Wait on MPD idle notifications and push status/volume only on change.
 
-    if BACKEND == "sonos":
-        # YouTube URLs not supported on Sonos
-        if is_youtube_url(station_url):
-            out = {'result':'error','message':'YouTube Music is not supported on Sonos'}
-            return jsonify(out)
-        zone = data['zone']
-        SoCo(zs[zone]).play_uri("x-rincon-mp3radio://"+station_url,title=station)
-        out = {'result':'success','station':station,'zone':zone}
+    Stream titles arrive as player events; STATUS_POLL_INTERVAL is the fallback
+    for sources MPD can't tell us about (KCRW's API, Apple Music via osa).
+    """
+    stale = True   # MPD's state is unknown: at start, and after losing it
+    while True:
+        try:
+            if stale:
+                broadcast.update('mpc', volume=int(get_vol_mpc()))
+                push_status()
+                stale = False
+            changed = mpd.idle("player", "mixer", "playlist", timeout=STATUS_POLL_INTERVAL)
+            if "mixer" in changed: broadcast.update('mpc', volume=int(get_vol_mpc()))
+            if changed != ["mixer"]: push_status()
+        except Exception as E:
+            print(f"MPD watcher error: {E}")
+            stale = True
+            time.sleep(5)
 
-    if BACKEND == "mpc":
-        clear_mpc()
-        # Extract stream URL for YouTube URLs
-        if is_youtube_url(station_url):
-            print(f"Station Down: extracting stream URL for {station}...")
-            stream_url = get_youtube_stream_url(station_url)
-            if stream_url:
-                station_url = stream_url
-            else:
-                out = {'result':'error','message':'Could not extract YouTube stream URL'}
-                return jsonify(out)
-        add_mpc(station_url)
-        if osa and current_station.find("Apple Music") == 0:
-            play_osa()
-        else:
-            play_mpc()
-        out = {'result':'success','station':station}
 
-    socketio.emit("play",out)
-    if pync: notify(f"Playing {station}",title='NT')
-    return jsonify(out)
+started = False
 
+def create_app():
+    """Start everything that talks to the outside world and return the app.
 
-status = None
+    Importing this module only defines things: the settings file, speakers,
+    station sheet, history db, MQTT broker and background threads are all
+    first touched here, and anything slow runs on those threads so the
+    first request is answered straight away.
+    """
+    global started
+    if started: return app
+    started = True
 
-def periodic_task():
-    global status
-    while True:
-        this_status = get_status_mpc()
-        if state != "stopped" and this_status != status: 
-            try: this_status['time']
-            except: None
-            status = this_status
-            socketio.emit('status', status)
-            if pync and (status['title'] is not status['artist']): notify(f"Playing {status['title']} by {status['artist']} on {status['station']}",title='NT',open=BURL)
+    if not os.path.exists('settings.py'):
+        shutil.copy('settings.py.example', 'settings.py')
+        print("Created settings.py from settings.py.example")
+        print("Please edit settings.py to configure your setup")
+    if pync: print("will let you know stuff")
 
-        time.sleep(2)
+    broadcast.start()
+    if BACKEND == "sonos":
+        load_zones()
+        threading.Thread(target=zone_watcher, daemon=True).start()
+    if BACKEND == "mpc": zs['mpc'] = 'mpc'
 
-# Start the periodic task in a separate thread
-threading.Thread(target=periodic_task, daemon=True).start()
+    # The cached list is served right away; the sheet is checked in the background
+    if catalog.load(): print(f"Loaded {len(catalog)} stations from {STATIONS_CACHE}")
+    for target in (station_refresher, youtube_refresher, health_prober, metadata_refresher, history_writer, assets.preload):
+        threading.Thread(target=target, daemon=True).start()
 
-# Start MQTT client in background thread if mqtt mode enabled
-if ENABLE_MQTT:
-    def mqtt_loop():
-        try:
-            client.connect(MQTT_BROKER, MQTT_PORT, 60)
-            print(f"MQTT connected to {MQTT_BROKER}:{MQTT_PORT}")
-            client.loop_forever()
-        except Exception as e:
-            print(f"MQTT connection error: {e}")
+    # Start the MPD watcher in a separate thread
+    if BACKEND == "mpc": threading.Thread(target=status_watcher, daemon=True).start()
 
-    threading.Thread(target=mqtt_loop, daemon=True).start()
-    print("MQTT client started in background")
+    # Start MQTT client in background thread if mqtt mode enabled; paho's loop
+    # thread keeps retrying the broker with backoff, including the first connect
+    if ENABLE_MQTT:
+        client.reconnect_delay_set(min_delay=1, max_delay=MQTT_RECONNECT_MAX)
+        client.connect_async(MQTT_BROKER, MQTT_PORT, 60)
+        client.loop_start()
+        print("MQTT client started in background")
+    return app
 
 if __name__ == '__main__':
+    # Allow PORT override via command line for backwards compatibility
+    if len(sys.argv) > 1:
+        try:
+            PORT = int(sys.argv[1])
+            BURL = f"http://localhost:{PORT}"
+        except:
+            pass
+    create_app()
     socketio.run(app,port=PORT,host="0.0.0.0",allow_unsafe_werkzeug=True)